@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# Requests and tokens per minute of the rate limiter during the benchmark. The mock server sends no
+# x-ratelimit-* headers, so the tier-1 defaults would throttle the benchmark instead of the server.
+MOCK_RATE_LIMITS = (1_000_000, 1_000_000_000)
+
+SURNAMES = [
+    "Anders", "Bakker", "Castillo", "Dubois", "Eriksen", "Fischer", "Garcia", "Hansen", "Ivanova", "Jansen",
+    "Kowalski", "Lindqvist", "Moreau", "Nakamura", "Olsen", "Petrov", "Quinn", "Rossi", "Schmidt", "Tanaka",
+    "Ueda", "Visser", "Weber", "Xu", "Yilmaz", "Zhang", "Brennan", "Costa", "Dekker", "Ferreira"
+]
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "te", "vo", "pa", "di", "ga", "no", "re", "shi", "tu", "be"]
+
+
+def make_vocabulary(rng: random.Random, size: int = 2000) -> list[str]:
+    return sorted({"".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(size)})
+
+
+def make_sentence(rng: random.Random, vocabulary: list[str]) -> str:
+    return " ".join(rng.choice(vocabulary) for _ in range(rng.randint(10, 25))).capitalize() + "."
+
+
+def make_source_text(rng: random.Random, vocabulary: list[str], words: int) -> tuple[str, list[str]]:
+    """
+    Returns the raw text of a source, as extracted from a PDF: wrapped lines and page markers, and its sentences.
+    """
+    sentences = []
+    while sum(len(sentence.split()) for sentence in sentences) < words:
+        sentences.append(make_sentence(rng, vocabulary))
+    pages = []
+    for start in range(0, len(sentences), 40):
+        paragraphs = [" ".join(sentences[i:i + 5]) for i in range(start, min(start + 40, len(sentences)), 5)]
+        pages.append("\n\n".join(textwrap.fill(paragraph, 80) for paragraph in paragraphs))
+    raw_text = "".join(f"\n----- Page {i} -----\n{page}\n" for i, page in enumerate(pages, start=1))
+    return raw_text, sentences
+
+
+def make_claim(rng: random.Random, sentence: str) -> str:
+    """
+    Paraphrases a sentence of a source by dropping some of its words.
+    """
+    words = sentence.rstrip(".").split()
+    kept = [word for word in words if rng.random() < 0.7] or words[:3]
+    return " ".join(kept).lower()
+
+
+def generate_corpus(directory: str, references: int, paragraphs: int, source_words: int, seed: int):
+    """
+    Writes sources/references.txt, source_texts/ and doc_to_check/doc_to_check.txt to the directory.
+    Every reference has a unique first author and year, so the citations can be mapped locally.
+    """
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    for folder in ("sources", "source_texts", "doc_to_check"):
+        os.makedirs(os.path.join(directory, folder), exist_ok=True)
+
+    authors = [(rng.choice(SURNAMES), rng.choice(SURNAMES)) for _ in range(references)]
+    years = rng.sample(range(1950, 2025), references) if references <= 75 else \
+        [1950 + i % 75 for i in range(references)]
+    citations = []
+    source_sentences = []
+    reference_lines = []
+    for i, ((first, second), year) in enumerate(zip(authors, years), start=1):
+        first = f"{first}{'' if i <= len(SURNAMES) else i}"
+        title = make_sentence(rng, vocabulary).rstrip(".")
+        reference_lines.append(f"{first}, A., & {second}, B. ({year}). {title}. Journal of Studies, {i}(1), 1-20.")
+        citations.append(rng.choice([f"({first} & {second}, {year})", f"{first} and {second} ({year})"]))
+        raw_text, sentences = make_source_text(rng, vocabulary, source_words)
+        with open(os.path.join(directory, "source_texts", f"[{i}] {first} {year}.txt"), "w", encoding="utf-8") as f:
+            f.write(raw_text)
+        source_sentences.append(sentences)
+
+    with open(os.path.join(directory, "sources", "references.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(reference_lines) + "\n")
+
+    doc_paragraphs = []
+    for p in range(paragraphs):
+        cited = rng.sample(range(references), min(references, rng.randint(1, 3)))
+        if p < references:
+            cited[0] = p  # every reference is cited at least once
+        claims = [f"{make_claim(rng, rng.choice(source_sentences[i])).capitalize()} {citations[i]}."
+                  for i in dict.fromkeys(cited)]
+        doc_paragraphs.append(" ".join(claims))
+    with open(os.path.join(directory, "doc_to_check", "doc_to_check.txt"), "w", encoding="utf-8") as f:
+        f.write("\n\n".join(doc_paragraphs) + "\n")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock_server(port: int, args) -> subprocess.Popen:
+    server = subprocess.Popen([
+        sys.executable, os.path.join(REPO_DIR, "mock_openai_server.py"), "--port", str(port),
+        "--latency", str(args.latency), "--jitter", str(args.jitter), "--error-rate", str(args.error_rate),
+        "--bad-quote-rate", str(args.bad_quote_rate), "--seed", str(args.seed)
+    ], stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("The mock server did not start")
+
+
+def count_items(stage_name: str) -> int:
+    """
+    The number of items a stage processed, to compute its throughput.
+    """
+    def load(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    if stage_name == "sanitize_sources":
+        return len(os.listdir("source_texts"))
+    if stage_name == "sanitize_doc":
+        return 1
+    if stage_name == "map_citations":
+        return len(load("doc_to_check/citation_map.json"))
+    if stage_name == "map_files":
+        return len(load("doc_to_check/file_map.json"))
+    if stage_name == "summarize":
+        return len(load("doc_to_check/citation_summary.json"))
+    return sum(len(paragraphs) for paragraphs in load("doc_to_check/claims.json").values())
+
+
+def run_benchmark(args) -> list[dict]:
+    # The modules of the pipeline use paths relative to the working directory, and llm_client creates its
+    # client and cache when it is imported, so they are only imported once the corpus and server are ready.
+    import llm_client
+    from instrumentation import TRACE_PATH, read_trace, start_trace
+    from openai import OpenAI
+    from pipeline import SETTINGS, STAGES, order_stages
+    from rate_limiter import DEFAULT_LIMITS, RateLimiter
+
+    llm_client.client = OpenAI(api_key="mock", base_url=os.environ["OPENAI_BASE_URL"], max_retries=0)
+    llm_client.rate_limiter = RateLimiter(limits={model: MOCK_RATE_LIMITS for model in DEFAULT_LIMITS})
+    SETTINGS["check_claims"].update(max_workers=args.workers, group_by_paper=args.group_by_paper,
+                                    use_retrieval=args.use_retrieval, stream=args.stream)
+    SETTINGS["validate_claims"].update(backend=args.backend)
+
+    results = []
+    seen_events = 0
+    for run in range(1, args.runs + 1):
+        for stage in order_stages(STAGES):
+            start_trace(stage.name)
+            started = time.perf_counter()
+            stage.run()
+            wall_s = time.perf_counter() - started
+            events = read_trace(TRACE_PATH)
+            stage_events = events[seen_events:]
+            calls = [event for event in stage_events if event["event"] == "llm_call"]
+            seen_events = len(events)
+            items = count_items(stage.name)
+            results.append({
+                "run": run,
+                "stage": stage.name,
+                "wall_s": round(wall_s, 3),
+                "items": items,
+                "items_per_s": round(items / wall_s, 2) if wall_s else None,
+                "llm_calls": len(calls),
+                "cache_hits": sum(1 for call in calls if call["cache_hit"]),
+                "errors": sum(1 for call in calls if call.get("error")),
+                "aborted": sum(1 for call in calls if call.get("aborted")),
+                "transport_retries": sum(1 for event in stage_events if event["event"] == "transport_retry"),
+            })
+
+    with open("doc_to_check/check_citations.json", "r", encoding="utf-8") as f:
+        checked = json.load(f)
+    entries = [entry for entries in checked.values() for entry in entries]
+    print(f"Quotes found for {sum(1 for entry in entries if entry['quote'])} of {len(entries)} claims")
+    return results
+
+
+def print_results(results: list[dict]):
+    print(f"{'run':>3} {'stage':<18} {'wall s':>8} {'items':>6} {'items/s':>9} {'calls':>6} {'cached':>6} "
+          f"{'errors':>6} {'aborted':>7} {'retries':>7}")
+    for result in results:
+        print(f"{result['run']:>3} {result['stage']:<18} {result['wall_s']:>8.2f} {result['items']:>6} "
+              f"{result['items_per_s'] or 0:>9.1f} {result['llm_calls']:>6} {result['cache_hits']:>6} "
+              f"{result['errors']:>6} {result['aborted']:>7} {result['transport_retries']:>7}")
+    for run in sorted({result["run"] for result in results}):
+        total = sum(result["wall_s"] for result in results if result["run"] == run)
+        print(f"Run {run}: {total:.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipeline on a synthetic corpus against a mock OpenAI API.")
+    parser.add_argument("--references", type=int, default=20, help="number of references and source texts")
+    parser.add_argument("--paragraphs", type=int, default=60, help="number of paragraphs in the document")
+    parser.add_argument("--source-words", type=int, default=5000, help="words per source text")
+    parser.add_argument("--latency", type=float, default=0.05, help="minimum latency of the mock API in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="random extra latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests that fail with a 500")
+    parser.add_argument("--bad-quote-rate", type=float, default=0.0,
+                        help="share of answers quoting the paragraph or invented text")
+    parser.add_argument("--workers", type=int, default=8, help="max_workers of check_claims")
+    parser.add_argument("--group-by-paper", action="store_true")
+    parser.add_argument("--use-retrieval", action="store_true")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--backend", choices=["openai", "local"], default="openai")
+    parser.add_argument("--runs", type=int, default=1, help="later runs show the effect of the LLM cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="directory for the corpus and outputs, a new temporary one by default")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="citation_benchmark_"))
+    output = os.path.abspath(args.output) if args.output else None
+    generate_corpus(workdir, args.references, args.paragraphs, args.source_words, args.seed)
+    print(f"Corpus written to {workdir}")
+
+    port = free_port()
+    mock_server = start_mock_server(port, args)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+    os.environ["OPENAI_API_KEY"] = "mock"
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(workdir)
+    try:
+        benchmark_results = run_benchmark(args)
+    finally:
+        mock_server.terminate()
+
+    print_results(benchmark_results)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), "results": benchmark_results}, f, indent=2)
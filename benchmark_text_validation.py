@@ -0,0 +1,241 @@
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import textwrap
+import time
+import tracemalloc
+
+from benchmark_pipeline import make_sentence, make_vocabulary
+from pdf_text_sanitizer import remove_diacritics, sanitize_lines, sanitize_text, split_columns_from_txt
+from text_validation import (NormalizedDocument, align_quote, match_trigrams, normalize_text,
+                             reconstruct_from_trigrams, validate_gaps)
+
+BASELINE_PATH = "benchmark_baseline.json"
+PAPER_SIZES = [10_000, 100_000, 1_000_000, 5_000_000]  # characters
+QUOTE_WORDS = [10, 40, 160]
+NOISE_LEVELS = [0.0, 0.01, 0.05]  # share of the letters of the paper changed by OCR errors
+REGRESSION_THRESHOLD = 0.25
+# Differences below these are measurement noise, whatever the ratio
+MIN_TIME_DIFFERENCE_S = 0.002
+MIN_MEMORY_DIFFERENCE_BYTES = 64 * 1024
+MIN_TIMED_S = 0.2  # a case is repeated until it ran this long, or --repeat times
+
+ACCENTED = {"a": "á", "e": "é", "i": "í", "o": "ö", "u": "ü", "n": "ñ"}
+MALFORMED_DIACRITICS = "¨´ˆ˘"
+
+
+def make_paper(rng: random.Random, size: int) -> tuple[str, list[str]]:
+    """
+    Returns the raw text of a paper of about size characters, as extracted from a PDF, and its sentences.
+    Pages have page markers and wrapped lines, every third page is laid out in two columns, and some letters are
+    accented.
+    """
+    vocabulary = make_vocabulary(rng)
+    for word in rng.sample(vocabulary, len(vocabulary) // 20):
+        vocabulary.append("".join(ACCENTED.get(ch, ch) for ch in word))
+    sentences = []
+    length = 0
+    while length < size:
+        sentences.append(make_sentence(rng, vocabulary))
+        length += len(sentences[-1]) + 1
+
+    pages = []
+    for page_number, start in enumerate(range(0, len(sentences), 30), start=1):
+        text = " ".join(sentences[start:start + 30])
+        if page_number % 3:
+            page = "\n\n".join(textwrap.fill(paragraph, 80) for paragraph in textwrap.wrap(text, 800))
+        else:
+            lines = textwrap.wrap(text, 45)
+            half = (len(lines) + 1) // 2
+            page = "\n".join(f"{left:<45}      {right}" for left, right in zip(lines[:half], lines[half:] + [""]))
+        pages.append(f"----- Page {page_number} -----\n{page}\n{page_number}\n")
+    return "\n".join(pages), sentences
+
+
+def add_ocr_noise(rng: random.Random, text: str, level: float) -> str:
+    """
+    Changes a share level of the letters: most are replaced by a similar looking one, some get a malformed
+    diacritic in front or are dropped.
+    """
+    if not level:
+        return text
+    similar = {"l": "1", "o": "0", "e": "c", "a": "o", "i": "l", "n": "m", "u": "v", "s": "5", "t": "f", "r": "n"}
+    chars = []
+    for ch in text:
+        if ch.isalpha() and rng.random() < level:
+            draw = rng.random()
+            if draw < 0.7:
+                chars.append(similar.get(ch, "x"))
+            elif draw < 0.9:
+                chars.append(rng.choice(MALFORMED_DIACRITICS) + ch)
+            continue
+        chars.append(ch)
+    return "".join(chars)
+
+
+def make_quote(rng: random.Random, sentences: list[str], words: int) -> str:
+    """
+    Returns the first words of consecutive sentences from the middle of the paper, as the LLM would quote them.
+    """
+    start = len(sentences) // 2 + rng.randint(0, max(0, len(sentences) // 4))
+    quote_words = []
+    for sentence in sentences[start:] + sentences[:start]:
+        quote_words.extend(sentence.split())
+        if len(quote_words) >= words:
+            break
+    return " ".join(quote_words[:words])
+
+
+def measure(function, repeat: int) -> tuple[float, int]:
+    """
+    Returns the best time of up to repeat calls, stopping once they took MIN_TIMED_S, and the peak memory
+    allocated by one more call, traced separately because tracing slows the calls down.
+    """
+    best = math.inf
+    total = 0.0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = min(best, elapsed)
+        total += elapsed
+        if total >= MIN_TIMED_S:
+            break
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def benchmark_cases(sizes: list[int], quote_lengths: list[int], noise_levels: list[float], seed: int):
+    """
+    Yields (benchmark name, parameters, function) for every function and point of the sweep.
+    """
+    for size in sizes:
+        rng = random.Random(seed)
+        clean_paper, sentences = make_paper(rng, size)
+        for noise in noise_levels:
+            raw_paper = add_ocr_noise(rng, clean_paper, noise)
+            params = {"size": size, "noise": noise}
+            yield "remove_diacritics", params, lambda: remove_diacritics(raw_paper)
+            yield "split_columns_from_txt", params, lambda: split_columns_from_txt(raw_paper)
+            yield "sanitize_lines", params, lambda: sanitize_lines(raw_paper)
+            yield "sanitize_text", params, lambda: sanitize_text(raw_paper)
+
+            paper = sanitize_text(raw_paper)
+            yield "normalize_text", params, lambda: normalize_text(paper)
+            yield "NormalizedDocument", params, lambda: NormalizedDocument(paper)
+            doc = NormalizedDocument(paper)
+            reconstruct_from_trigrams(paper, "")  # the document is normalized once per paper, not per quote
+            for words in quote_lengths:
+                quote = make_quote(rng, sentences, words)
+                quote_params = {**params, "quote_words": words}
+                parts, _ = match_trigrams(doc, quote)
+                yield "reconstruct_from_trigrams", quote_params, lambda: reconstruct_from_trigrams(paper, quote)
+                yield "validate_gaps", quote_params, lambda: validate_gaps(parts)
+                yield "align_quote", quote_params, lambda: align_quote(doc, quote)
+
+
+def case_id(name: str, params: dict) -> str:
+    return name + "".join(f" {key}={value}" for key, value in params.items())
+
+
+def run_benchmarks(sizes: list[int], quote_lengths: list[int], noise_levels: list[float], seed: int,
+                   repeat: int) -> list[dict]:
+    results = []
+    for name, params, function in benchmark_cases(sizes, quote_lengths, noise_levels, seed):
+        time_s, peak_bytes = measure(function, repeat)
+        results.append({"id": case_id(name, params), "benchmark": name, **params, "time_s": time_s,
+                        "peak_bytes": peak_bytes})
+        print(f"{case_id(name, params):<72} {time_s * 1000:10.3f} ms {peak_bytes / 1e6:9.2f} MB", flush=True)
+    return results
+
+
+def scaling_exponents(results: list[dict]) -> dict[str, float]:
+    """
+    Fits time = c * size^k for every benchmark and setting of the other parameters, with least squares on the
+    logarithms. k is about 1 for linear and 2 for quadratic functions of the paper size.
+    """
+    curves = dict()
+    for result in results:
+        key = case_id(result["benchmark"], {k: v for k, v in result.items() if k in ("noise", "quote_words")})
+        curves.setdefault(key, []).append((math.log(result["size"]), math.log(max(result["time_s"], 1e-9))))
+
+    exponents = dict()
+    for key, points in curves.items():
+        if len({x for x, _ in points}) < 2:
+            continue
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        exponents[key] = sum((x - mean_x) * (y - mean_y) for x, y in points) / \
+            sum((x - mean_x) ** 2 for x, _ in points)
+    return exponents
+
+
+def find_regressions(results: list[dict], baseline: list[dict], threshold: float) -> list[str]:
+    """
+    Compares the results with the baseline cases of the same id. A case regressed if its time or peak memory grew
+    by more than the threshold, a share of the baseline, and by more than the measurement noise.
+    """
+    baseline_by_id = {result["id"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        old = baseline_by_id.get(result["id"])
+        if old is None:
+            continue
+        if result["time_s"] > old["time_s"] * (1 + threshold) and \
+                result["time_s"] - old["time_s"] > MIN_TIME_DIFFERENCE_S:
+            regressions.append(f"{result['id']}: time {old['time_s'] * 1000:.3f} ms -> "
+                               f"{result['time_s'] * 1000:.3f} ms")
+        if result["peak_bytes"] > old["peak_bytes"] * (1 + threshold) and \
+                result["peak_bytes"] - old["peak_bytes"] > MIN_MEMORY_DIFFERENCE_BYTES:
+            regressions.append(f"{result['id']}: peak memory {old['peak_bytes'] / 1e6:.2f} MB -> "
+                               f"{result['peak_bytes'] / 1e6:.2f} MB")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark text_validation and pdf_text_sanitizer on synthetic papers.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=PAPER_SIZES, help="paper sizes in characters")
+    parser.add_argument("--quote-words", type=int, nargs="+", default=QUOTE_WORDS)
+    parser.add_argument("--noise", type=float, nargs="+", default=NOISE_LEVELS, help="OCR noise levels")
+    parser.add_argument("--repeat", type=int, default=5, help="maximum number of timed calls per case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="relative slowdown or memory growth reported as a regression")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmarks(args.sizes, args.quote_words, args.noise, args.seed, args.repeat)
+
+    print("Scaling with the paper size (time ~ size^k):")
+    for curve, exponent in scaling_exponents(benchmark_results).items():
+        print(f"  k = {exponent:5.2f}  {curve}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(benchmark_results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(benchmark_results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline_results = json.load(f)
+        regressions = find_regressions(benchmark_results, baseline_results, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} of {args.baseline}")
+    else:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create it")
@@ -1,13 +1,15 @@
+import argparse
 import json
 import re
 import os
-from dotenv import load_dotenv
-from openai import OpenAI
+import unicodedata
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-
-load_dotenv(override=True)
-api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+from instrumentation import start_trace, trace_context
+import llm_client
+from llm_client import chat_completion, print_cache_stats
+from model_cascade import ModelCascade
 
 
 def extract_json_block(text: str) -> str:
@@ -17,16 +19,274 @@ def extract_json_block(text: str) -> str:
     raise ValueError("No JSON block found in the response")
 
 
-def map_citations_to_references(paper_txt: str, references_txt: str) -> dict:
+SECTION_CHARS = 20000
+INVALID_JSON_MESSAGE = ("Your response did not contain a valid JSON block. Return the JSON dictionary of the "
+                        "citations and their references between ```json and ``` and nothing else.")
+
+# Models that map the citations of a section, from the cheapest to the strongest. A model is only used when
+# the models before it did not give a valid map.
+mapper_cascade = ModelCascade("citation_mapper", ["gpt-4o-mini", "gpt-4o"])
+
+# Grammar of author-year and numeric in-text citations
+# Particles are capitalised at the start of a sentence, e.g. "Van der Berg et al. (2021) found"
+NAME_PARTICLE = r"(?:(?i:van|von|de|der|den|du|da|di|dos|le|la|ten|ter)\s+)"
+SURNAME = rf"{NAME_PARTICLE}*[A-Z][^\W\d_]*(?:[-'’][A-Z]?[^\W\d_]+)*"
+AUTHORS = rf"{SURNAME}(?:,\s+{SURNAME})*(?:,?\s+(?:and|&)\s+{SURNAME})?(?:\s+et\s+al\.?)?"
+# Outside parentheses, a list of surnames must end in "and" or "&", so a capitalised word before the citation,
+# as in "However, Smith (2020)", is not taken for an author
+NARRATIVE_AUTHORS = rf"{SURNAME}(?:(?:,\s+{SURNAME})*,?\s+(?:and|&)\s+{SURNAME})?(?:\s+et\s+al\.?)?"
+YEAR = r"(?:19|20)\d{2}[a-z]?"
+NARRATIVE_CITATION = re.compile(rf"\b{NARRATIVE_AUTHORS}\s+\({YEAR}\)")
+PARENTHETICAL_CITATION = re.compile(rf"{AUTHORS},?\s+{YEAR}")
+PARENTHESES = re.compile(r"\(([^()]*)\)")
+NUMERIC_CITATION = re.compile(r"\[(\d+(?:\s*[,\u2013-]\s*\d+)*)]")
+
+
+def normalize_name(name: str) -> str:
+    name = unicodedata.normalize("NFD", name)
+    return re.sub(r"[^a-z]", "", "".join(c for c in name if not unicodedata.combining(c)).lower())
+
+
+def first_author_surname(author_part: str) -> str:
+    """
+    Returns the surname of the first author of a reference, e.g. "van der Berg" for "van der Berg, A. J., & Ho, B.".
+    """
+    first_author = re.sub(r"^\s*\[?\d+[.\]]\s*", "", author_part).split(",")[0]
+    tokens = [token for token in first_author.split() if not re.fullmatch(r"(?:[A-Z]\.-?)+|[A-Z]{1,2}", token)]
+    return " ".join(tokens)
+
+
+def find_citations(paper_txt: str) -> list[str]:
+    """
+    Finds the author-year citations, e.g. "Smith et al. (2023)" or the items of "(Smith, 2020; Lee & Ho, 2019)",
+    and the numeric citations, e.g. "[12]", in the text. Returns the unique citations in order of appearance.
+    """
+    citations = dict()
+    for match in NARRATIVE_CITATION.finditer(paper_txt):
+        citations[match.group()] = None
+    for parentheses in PARENTHESES.finditer(paper_txt):
+        for match in PARENTHETICAL_CITATION.finditer(parentheses.group(1)):
+            citations[match.group()] = None
+    for match in NUMERIC_CITATION.finditer(paper_txt):
+        citations[match.group()] = None
+    return list(citations)
+
+
+def parse_citation(citation: str) -> tuple[list[str], str, bool] | None:
+    """
+    Returns the normalized surnames, the year and whether the citation contains "et al.",
+    or None if the citation is not an author-year citation.
+    """
+    year = re.search(YEAR + "$", citation.rstrip(")"))
+    if not year:
+        return None
+    authors = citation[:year.start()]
+    et_al = bool(re.search(r"\bet\s+al\b", authors))
+    authors = re.sub(r"\bet\s+al\.?|[(),]", " ", authors)
+    surnames = [normalize_name(name) for name in re.split(r"\s+(?:and|&)\s+|\s{2,}|,", authors)]
+    return [surname for surname in surnames if surname], year.group(), et_al
+
+
+class ReferenceIndex:
+    """
+    Indexes the reference lines by the surname of their first author and their year, with or without the
+    letter suffix (2020a).
+    """
+
+    def __init__(self, references_txt: str):
+        self.lines = [line for line in references_txt.splitlines() if line.strip()]
+        self.by_author_year = dict()
+        self.by_number = dict()
+        self.author_names = []
+        for i, line in enumerate(self.lines):
+            number = re.match(r"\s*\[?(\d+)[.\]]\s*", line)
+            if number:
+                self.by_number[int(number.group(1))] = i
+                line = line[number.end():]
+            year = re.search(rf"\b{YEAR}\b", line)
+            author_part = line[:year.start()] if year else line
+            names = {normalize_name(name) for name in re.findall(SURNAME, author_part)}
+            self.author_names.append({name for name in names if len(name) > 1})  # skip initials
+            first_surname = normalize_name(first_author_surname(author_part))
+            for ref_year in set(re.findall(rf"\b({YEAR})\b", line)):
+                self.by_author_year.setdefault((first_surname, ref_year), []).append((i, True))
+                if ref_year[-1].isalpha():
+                    self.by_author_year.setdefault((first_surname, ref_year[:-1]), []).append((i, False))
+
+    def match(self, citation: str) -> str | None:
+        """
+        Returns the reference line of the citation, or None if there is no single best match.
+        """
+        numeric = re.fullmatch(r"\[(\d+)]", citation)
+        if numeric:
+            i = self.by_number.get(int(numeric.group(1)))
+            return self.lines[i] if i is not None else None
+
+        parsed = parse_citation(citation)
+        if not parsed or not parsed[0]:
+            return None
+        surnames, year, et_al = parsed
+        candidates = self.by_author_year.get((surnames[0], year), [])
+        if len(candidates) > 1:
+            # Prefer the references containing most of the cited co-authors, then the ones with a matching
+            # number of authors, then the ones with the exact year rather than one with a letter suffix.
+            def score(candidate):
+                i, exact_year = candidate
+                names = self.author_names[i]
+                cited = sum(1 for surname in surnames if surname in names)
+                author_count_matches = len(names) > 2 if et_al else len(names) == len(surnames)
+                return cited, author_count_matches, exact_year
+            best = max(score(candidate) for candidate in candidates)
+            candidates = [candidate for candidate in candidates if score(candidate) == best]
+        return self.lines[candidates[0][0]] if len(candidates) == 1 else None
+
+
+def local_citation_map(paper_txt: str, references_txt: str) -> tuple[dict, list[str]]:
+    """
+    Maps the citations found by the citation grammar to the reference lines, without an LLM.
+    Returns the map and the citations that could not be resolved.
+    """
+    index = ReferenceIndex(references_txt)
+    citation_map = dict()
+    unresolved = []
+    for citation in find_citations(paper_txt):
+        candidate = citation
+        ref_line = index.match(candidate)
+        while ref_line is None and (candidate := drop_first_name(candidate)):
+            ref_line = index.match(candidate)
+        if ref_line:
+            citation_map[candidate] = ref_line
+        else:
+            unresolved.append(citation)
+    return citation_map, unresolved
+
+
+def drop_first_name(citation: str) -> str | None:
+    """
+    Returns the citation without its first name if the rest is a citation too, e.g. "Lee and Ho (2019)" for
+    "Europe, Lee and Ho (2019)", where the grammar took a capitalised word before the citation for an author.
+    """
+    _, separator, rest = citation.partition(", ")
+    if separator and (NARRATIVE_CITATION.fullmatch(rest) or PARENTHETICAL_CITATION.fullmatch(rest)):
+        return rest
+    return None
+
+
+def select_unresolved_paragraphs(paper_txt: str, unresolved_citations: list[str],
+                                 unresolved_references: list[str]) -> str:
+    """
+    Returns the paragraphs that contain an unresolved citation or the first author of an unresolved reference.
+    """
+    surnames = set()
+    for line in unresolved_references:
+        year = re.search(rf"\b{YEAR}\b", line)
+        surname = re.search(r"[A-Z][^\W\d_]{2,}", first_author_surname(line[:year.start()] if year else line))
+        if surname:
+            surnames.add(surname.group())
+    needles = list(unresolved_citations) + sorted(surnames)
+    paragraphs = [p for p in re.split(r"\n{2,}", paper_txt) if any(needle in p for needle in needles)]
+    return "\n\n".join(paragraphs)
+
+
+def map_citations_to_references(paper_txt: str, references_txt: str, max_workers: int = 4) -> dict:
+    """
+    Maps the citations locally first. Only the citations and references left unresolved are sent to the LLM,
+    together with the paragraphs they occur in.
+    """
+    citation_map, unresolved_citations = local_citation_map(paper_txt, references_txt)
+    mapped_references = set(citation_map.values())
+    unresolved_references = [line for line in references_txt.splitlines()
+                             if line.strip() and line not in mapped_references]
+    if not unresolved_citations and not unresolved_references:
+        return citation_map
+
+    excerpt = select_unresolved_paragraphs(paper_txt, unresolved_citations, unresolved_references)
+    if excerpt:
+        citation_map = llm_map_citations(excerpt, references_txt, citation_map, max_workers)
+
+    for error in validate_citation_map(citation_map, paper_txt, references_txt):
+        print(error)
+    return citation_map
+
+
+def split_into_sections(text: str, max_chars: int = SECTION_CHARS) -> list[str]:
+    """
+    Groups the paragraphs of the text into sections of at most max_chars characters,
+    unless a single paragraph is longer.
+    """
+    sections = []
+    current = []
+    size = 0
+    for paragraph in re.split(r"\n{2,}", text):
+        if current and size + len(paragraph) > max_chars:
+            sections.append("\n\n".join(current))
+            current = []
+            size = 0
+        current.append(paragraph)
+        size += len(paragraph) + 2
+    if current:
+        sections.append("\n\n".join(current))
+    return sections
+
+
+def llm_map_citations(text: str, references_txt: str, known_map: dict, max_workers: int = 4) -> dict:
+    """
+    Maps the citations in the text with the LLM, one section at a time, concurrently. The section maps are merged
+    into the known map, which takes precedence.
+    """
+    sections = split_into_sections(text)
+    reference_lines = {line.strip() for line in references_txt.splitlines() if line.strip()}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        section_maps = list(executor.map(
+            lambda section: llm_map_section(section, references_txt, reference_lines, known_map), sections
+        ))
+    return merge_section_maps(section_maps, known_map)
+
+
+def merge_section_maps(section_maps: list[dict], known_map: dict) -> dict:
+    """
+    Merges the maps of all sections. When sections map a citation to different references,
+    the reference chosen by most sections wins, and on a tie the one of the first section.
+    """
+    votes = dict()
+    for section_map in section_maps:
+        for citation, ref_line in section_map.items():
+            votes.setdefault(citation, Counter())[ref_line] += 1
+
+    merged = dict(known_map)
+    for citation, ref_votes in votes.items():
+        if citation in merged:
+            continue
+        if len(ref_votes) > 1:
+            print(f"Conflicting references for {citation}: {list(ref_votes)}")
+        merged[citation] = ref_votes.most_common(1)[0][0]
+    return merged
+
+
+def llm_map_section(section_txt: str, references_txt: str, reference_lines: set[str], known_map: dict) -> dict:
+    section_map, errors = mapper_cascade.run(
+        lambda model: llm_map_section_with_model(section_txt, references_txt, reference_lines, known_map, model),
+        accept=lambda result: not result[1],
+        rank=lambda result: len(result[0])
+    )
+    return section_map
+
+
+def llm_map_section_with_model(section_txt: str, references_txt: str, reference_lines: set[str], known_map: dict,
+                               model: str) -> tuple[dict, list[str]]:
+    """
+    Returns the mappings of the section that are valid, and the errors of the last answer of the model.
+    """
     references = references_txt.splitlines()
+    known_citations = [citation for citation in known_map if citation in section_txt]
 
     prompt = f"""
-Given the full text of a scientific paper and a list of reference entries, identify all in-text citations
+Given a section of a scientific paper and a list of reference entries, identify all in-text citations
 (e.g., (Author et al., 2024), [1], etc.) and match each to the best corresponding line from the references list.
 
 Paper Text (between %%%):
 %%%
-{paper_txt}
+{section_txt}
 %%%
 
 References (between %%%):
@@ -34,6 +294,8 @@ References (between %%%):
 {references}
 %%%
 
+These citations have already been mapped, do NOT include them: {known_citations}
+
 Output a JSON dictionary where each citation in the text maps to the best matching line from the references.
 Only map UNIQUE citations. Map ALL citations. Pay attention to diacritics in references
 
@@ -56,56 +318,77 @@ Only map UNIQUE citations. Map ALL citations. Pay attention to diacritics in ref
         {"role": "user", "content": prompt}
     ]
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0.0
-    )
-
     max_retries = 2
     i = 0
-    json_obj = None
-    while i < max_retries:
+    json_obj = dict()
+    errors = ["No JSON block found in the responses"]
+    retry_reason = None
+    while i <= max_retries:
         i += 1
-        json_block = extract_json_block(response.choices[0].message.content)
-        json_obj = json.loads(json_block)
-        errors = validate_citation_map(json_obj, paper_txt, references_txt)
-        if not errors:
-            return json_obj
-        else:
-            messages.append({"role": "assistant", "content": json_block})
-            error_msg = f"""
-            I found the following problems:
-            {errors}
-            
-            Please fix them. Make sure to be EXACT in your response, because the validation is automatic. Also take diacritics in citations into account.
-            """
-            messages.append({"role": "user", "content": error_msg})
-
-            response = client.chat.completions.create(
-                model="gpt-4o",
+        with trace_context(attempt=i, retry_reason=retry_reason):
+            response = chat_completion(
+                model=model,
                 messages=messages,
                 temperature=0.0
             )
+        content = response.choices[0].message.content
+        try:
+            json_block = extract_json_block(content)
+            json_obj = json.loads(json_block)
+        except ValueError as e:
+            print(f"Failed to map the citations of a section: {e}")
+            # Without a correction, the retry would be the same request and be answered from the cache
+            retry_reason = "invalid_json"
+            messages.append({"role": "assistant", "content": content})
+            messages.append({"role": "user", "content": INVALID_JSON_MESSAGE})
+            continue
+
+        errors = validate_section_map(json_obj, section_txt, reference_lines)
+        if not errors:
+            return json_obj, errors
 
-    return json_obj if json_obj else {}
+        retry_reason = "validation_errors"
+        messages.append({"role": "assistant", "content": json_block})
+        error_msg = f"""
+        I found the following problems:
+        {errors}
+        
+        Please fix them. Make sure to be EXACT in your response, because the validation is automatic. Also take diacritics in citations into account.
+        """
+        messages.append({"role": "user", "content": error_msg})
+
+    # Keep the mappings that are valid
+    return {citation: ref_line for citation, ref_line in json_obj.items()
+            if citation in section_txt and ref_line.strip() in reference_lines}, errors
+
+
+def validate_section_map(section_map: dict, section_txt: str, reference_lines: set[str]) -> list[str]:
+    errors = []
+    for citation, ref_line in section_map.items():
+        if citation not in section_txt:
+            errors.append(f"Citation not found in paper: {citation}")
+        elif ref_line.strip() not in reference_lines:
+            errors.append(f"References not found in references: {ref_line}")
+    return errors
 
 
 def validate_citation_map(citation_map_json, paper_txt: str, references_txt: str) -> list[str]:
     errors = []
-    ref_lines = []
+    reference_lines = {line.strip() for line in references_txt.splitlines()}
+    mapped_lines = set()
     for citation, ref_line in citation_map_json.items():
-        ref_lines.append(ref_line)
+        mapped_lines.add(ref_line.strip())
         if citation not in paper_txt:
             errors.append(f"Citation not found in paper: {citation}")
-        elif ref_line not in references_txt:
+        elif ref_line.strip() not in reference_lines:
             errors.append(f"References not found in references: {ref_line}")
     for line in references_txt.splitlines():
-        if line not in ref_lines:
+        if line.strip() and line.strip() not in mapped_lines:
             errors.append(f"Reference has no citation: {line}")
 
     return errors
 
+
 def citation_map_to_file_map(citation_map_path: str, references_path: str, sources_dir: str, output_path: str):
     with open(citation_map_path, "r", encoding="utf-8") as f:
         citation_map = json.load(f)
@@ -136,6 +419,13 @@ def citation_map_to_file_map(citation_map_path: str, references_path: str, sourc
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map the citations of the document to its references and files.")
+    parser.add_argument("--refresh-cache", action="store_true",
+                        help="send the LLM requests again instead of reusing the cached answers of an earlier run")
+    args = parser.parse_args()
+    if args.refresh_cache:
+        llm_client.refresh_cache = True
+    start_trace("citation_mapper")
     with open("doc_to_check/doc_to_check.txt", "r", encoding="utf-8") as f:
         paper_txt = f.read()
 
@@ -152,3 +442,5 @@ if __name__ == "__main__":
         sources_dir="source_texts",
         output_path="doc_to_check/file_map.json"
     )
+    mapper_cascade.print_stats()
+    print_cache_stats()
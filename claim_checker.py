@@ -1,14 +1,16 @@
+import argparse
 import json
-import re
 import os
-from dotenv import load_dotenv
-from openai import OpenAI
-
-from text_validation import normalize_text, reconstruct_from_trigrams, validate_gaps, validate_and_reconstruct
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
-load_dotenv(override=True)
-api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+from context_retrieval import PassageIndex, TOP_K
+from instrumentation import record, start_trace, trace_context
+from llm_client import chat_completion, stream_chat_completion, StreamAborted, print_cache_stats
+from model_cascade import ModelCascade
+from token_budget import context_budget, estimate_message_tokens, split_into_windows
+from text_validation import normalize_text, get_normalized_document, validate_and_reconstruct, fuzzy_match
 
 
 def extract_json_block(text: str) -> str:
@@ -19,164 +21,554 @@ def extract_json_block(text: str) -> str:
 
 
 def paper_contains_text(paper: str, text: str) -> bool:
-    return normalize_text(text) in normalize_text(paper)
+    return get_normalized_document(paper).contains(text)
+
+
+# The system prompt and the paper text form a byte-identical prefix for every claim checked against the same
+# paper, so the provider's prompt cache can reuse it. Everything that varies per claim comes after it.
+SYSTEM_PROMPT = """You are an expert at verifying claims in scientific papers.
+
+Your task is to verify that claims referring to a paper are actually grounded in the paper.
+
+You are given:
+1. The full PAPER TEXT (between the FIRST set of triple percent signs, %%%).
+2. A CITATION referring to that paper.
+3. One or more PARAGRAPHS that contain a claim referencing that citation.
+
+IMPORTANT:
+- ONLY extract a quote from the PAPER TEXT.
+- DO NOT quote from the paragraph containing the claim.
+- Your quote will be checked by an automated string search on the PAPER TEXT. If it is not found there, your answer will be rejected.
+- If you cannot find any quote in the paper that supports the claim, respond with a valid quote from the paper that is MOST LIKELY related, and mark the confidence as "LOW".
+- If you mistakenly return text from the paragraph containing the claim, your response will be invalid.
+- The paper may contain mid-sentence interruptions by headers or layout artifacts, because the PDF was parsed to plain text. When quoting such a sentence or paragraph, you must include the erroneous text exactly as it appears. Do not fix or remove layout errors — if your quote does not match the paper verbatim, it will be rejected by exact-match checking.
+"""
+
+
+# Models asked for a quote, from the cheapest to the strongest, with the number of attempts each gets to give a
+# verifiable quote. A model is only asked when the models before it gave no verified quote, or one with LOW
+# confidence.
+MODEL_RETRIES = {"gpt-4o-mini": 2, "gpt-4o": 5}
+MAX_RETRIES = max(MODEL_RETRIES.values())
+# Tokens reserved for an answer with a single quote, and for a retry message
+QUOTE_TOKENS = 500
+RETRY_MESSAGE_TOKENS = 200
+CONFIDENCE_RANK = {"LOW": 0, "MEDIUM": 1, "HIGH": 2}
+
+# A streamed answer is aborted when this many consecutive word trigrams of its quote do not occur in the paper,
+# or when the first STREAM_MIN_PARAGRAPH_WORDS words of the quote are taken from the paragraph instead.
+STREAM_MAX_TRIGRAM_MISSES = 6
+STREAM_MIN_PARAGRAPH_WORDS = 8
+QUOTE_FIELD = re.compile(r'"quote"\s*:\s*"((?:[^"\\]|\\.)*)(")?')
+
+claim_cascade = ModelCascade("check_claim", list(MODEL_RETRIES))
+
+
+def build_paper_messages(paper_txt: str, excerpts: bool = False, part: tuple[int, int] | None = None) -> list[dict]:
+    if excerpts:
+        header = "PAPER TEXT (only the passages relevant to the claims, separated by [...]) (between %%%):"
+    elif part:
+        header = f"PAPER TEXT (part {part[0]} of {part[1]}, the other parts are sent separately) (between %%%):"
+    else:
+        header = "PAPER TEXT (between %%%):"
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"{header}\n%%%\n{paper_txt}\n%%%"}
+    ]
+
+
+def build_messages(citation: str, paragraph: str, paper_txt: str, excerpts: bool = False,
+                   part: tuple[int, int] | None = None) -> list[dict]:
+    prompt = f"""CITATION referring to this paper:
+{citation}
 
+PARAGRAPH containing the claim (between %%%):
+%%%
+{paragraph}
+%%%
 
-def check_claim(citation: str, paragraph: str, paper_txt: str) -> dict:
-    prompt = f"""
-    Your task is to verify that a claim referring to a paper is actually grounded in the paper.
+Return the EXACT sentence or paragraph from the PAPER TEXT that best substantiates the claim made about it in the paragraph.
+
+Your output must be valid JSON in the following format:
+"""
+
+    example = """
+```json
+{
+    "quote": "exact sentence from the PAPER TEXT that supports the claim."
+    "confidence": "LOW|MEDIUM|HIGH"
+}
+```
+"""
 
-    You are given:
-    1. The full PAPER TEXT (between the FIRST set of triple percent signs, %%%).
-    2. A CITATION referring to that paper.
-    3. A PARAGRAPH that contains a claim referencing that citation.
+    prompt += example
 
-    IMPORTANT:
-    - ONLY extract a quote from the PAPER TEXT.
-    - DO NOT quote from the paragraph containing the claim.
-    - Your quote will be checked by an automated string search on the PAPER TEXT. If it is not found there, your answer will be rejected.
-    - If you cannot find any quote in the paper that supports the claim, respond with a valid quote from the paper that is MOST LIKELY related, and mark the confidence as "LOW".
-    - If you mistakenly return text from the paragraph containing the claim, your response will be invalid.
-    - The paper may contain mid-sentence interruptions by headers or layout artifacts, because the PDF was parsed to plain text. When quoting such a sentence or paragraph, you must include the erroneous text exactly as it appears. Do not fix or remove layout errors — if your quote does not match the paper verbatim, it will be rejected by exact-match checking.
+    return build_paper_messages(paper_txt, excerpts, part) + [{"role": "user", "content": prompt}]
 
-    PAPER TEXT (between %%%):
-    %%%
-    {paper_txt}
-    %%%
 
-    CITATION referring to this paper: 
-    {citation}
+def build_multi_claim_messages(citation: str, paragraphs: list[str], paper_txt: str,
+                               excerpts: bool = False) -> list[dict]:
+    numbered_paragraphs = "\n\n".join(f"PARAGRAPH {i} (between %%%):\n%%%\n{paragraph}\n%%%"
+                                       for i, paragraph in enumerate(paragraphs, start=1))
+    prompt = f"""CITATION referring to this paper:
+{citation}
 
-    PARAGRAPH containing the claim (between %%%):
-    %%%
-    {paragraph}
-    %%%
+{numbered_paragraphs}
 
-    Return the EXACT sentence or paragraph from the PAPER TEXT that best substantiates the claim made about it in the paragraph.
+For EACH paragraph, return the EXACT sentence or paragraph from the PAPER TEXT that best substantiates the claim made about it in that paragraph.
 
-    Your output must be valid JSON in the following format:
-    """
+Your output must be valid JSON in the following format, with one item per paragraph:
+"""
 
     example = """
 ```json
 {
-    "quote": "exact sentence from the PAPER TEXT that supports the claim."
-    "confidence": "LOW|MEDIUM|HIGH"
+    "quotes": [
+        {
+            "paragraph": 1,
+            "quote": "exact sentence from the PAPER TEXT that supports the claim.",
+            "confidence": "LOW|MEDIUM|HIGH"
+        }
+    ]
 }
 ```
-    """
+"""
 
     prompt += example
 
-    messages = [
-        {"role": "system", "content": "You are an expert at verifying claims in scientific papers."},
-        {"role": "user", "content": prompt}
-    ]
+    return build_paper_messages(paper_txt, excerpts) + [{"role": "user", "content": prompt}]
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0.0
-    )
 
-    max_retries = 5
-    i = 0
+def verify_quote(paper_txt: str, quote: str) -> str | None:
+    """
+    Returns the quote if it is found in the paper, a reconstruction of it if the paper contains it with
+    small gaps, the closest span of the paper if it differs only slightly from the quote, or None if the
+    quote cannot be verified.
+    """
+    if paper_contains_text(paper_txt, quote):
+        record("verification", path="exact")
+        return quote
+    reconstructed_text = validate_and_reconstruct(paper_txt, quote)
+    if reconstructed_text:
+        record("verification", path="trigram")
+        return reconstructed_text
+    aligned_text = fuzzy_match(paper_txt, quote)
+    record("verification", path="fuzzy" if aligned_text else "failed")
+    return aligned_text
+
+
+def partial_quote(content: str) -> tuple[str, bool] | None:
+    """
+    Returns the value of the quote field in the JSON answer received so far, and whether it is complete,
+    or None if the quote did not start yet.
+    """
+    match = QUOTE_FIELD.search(content)
+    if not match:
+        return None
+    value = re.sub(r"\\u[0-9a-fA-F]{0,3}$", "", match.group(1))  # drop an unfinished escape
+    try:
+        return json.loads(f'"{value}"'), match.group(2) is not None
+    except ValueError:
+        return None
+
 
-    json_obj = {"quote": "", "confidence": "LOW"}
+class QuoteMonitor:
+    """
+    Follows the quote of a streamed answer and tells when it can no longer be verified against the paper:
+    when a run of its word trigrams does not occur in the paper, or when it is quoting the paragraph.
+    """
 
-    while i < max_retries:
-        i += 1
-        response_text = response.choices[0].message.content
+    def __init__(self, paragraph: str, paper_txt: str):
+        self.normalized_paragraph = normalize_text(paragraph)
+        self.doc = get_normalized_document(paper_txt)
+        self.quote = ""
+        self.checked = 0
+        self.misses = 0
+        self.from_paragraph = True
+
+    def should_abort(self, content: str) -> bool:
+        parsed = partial_quote(content)
+        if not parsed:
+            return False
+        self.quote, complete = parsed
+        words = self.quote.split()
+        if not complete and not self.quote[-1:].isspace():
+            words = words[:-1]  # the last word may not be complete yet
+        norm_words = [normalize_text(word) for word in words]
+
+        while self.checked + 3 <= len(norm_words):
+            trigram = "".join(norm_words[self.checked:self.checked + 3])
+            self.misses = self.misses + 1 if trigram not in self.doc.normalized else 0
+            self.checked += 1
+            if self.misses >= STREAM_MAX_TRIGRAM_MISSES:
+                return True
+
+        if self.from_paragraph and len(words) >= STREAM_MIN_PARAGRAPH_WORDS:
+            prefix = "".join(norm_words)
+            if prefix not in self.normalized_paragraph:
+                self.from_paragraph = False
+            elif prefix not in self.doc.normalized:
+                return True
+        return False
+
+
+def is_paragraph_quote(paragraph: str, quote: str) -> bool:
+    return normalize_text(quote) in normalize_text(paragraph)
+
+
+def retry_message(paragraph: str, quote: str) -> str:
+    if is_paragraph_quote(paragraph, quote):
+        return ("You returned an quote from the paragraph with the claim instead of from the paper. "
+                "I hope you realize this seriously jeopardizes are scientific project, as semantic similarity will be 100%. "
+                "Fix it and return the JSON with a quote from the paper instead nothing else.")
+    return ("AUTOMATIC VERIFICATION FAILED: the quote is not found in the paper. "
+            "Fix your response and return the JSON with an EXACT quote from the PAPER TEXT and nothing else."
+            "\nMaybe it's an idea to reduce your quote in size so it's more likely the text is found, "
+            "despite errors. Only semantically meaningful parts are needed.")
+
+
+INVALID_JSON_MESSAGE = ("Your response did not contain a valid JSON block. "
+                        "Return the JSON in the requested format with an EXACT quote from the PAPER TEXT and nothing else.")
+
+
+def split_paper(paper_txt: str, prompt_messages: list[dict], output_tokens: int, model: str) -> list[str]:
+    """
+    Splits the paper into windows that fit in the context window of the model, next to the rest of the prompt
+    and the output. Returns [paper_txt] if the whole paper fits.
+    """
+    budget = context_budget(model, estimate_message_tokens(prompt_messages), output_tokens)
+    return split_into_windows(paper_txt, budget)
 
-        try:
-            json_block = extract_json_block(response_text)
-            json_obj = json.loads(json_block)
-            response_text = json_obj['quote']
-        except ValueError:
-            continue
 
-        text_found = paper_contains_text(paper_txt, response_text)
+def claim_windows(citation: str, paragraph: str, paper_txt: str, model: str) -> list[str]:
+    # The last request of the retry loop contains the answers and retry messages of all earlier attempts
+    max_retries = MODEL_RETRIES.get(model, MAX_RETRIES)
+    output_tokens = max_retries * QUOTE_TOKENS + (max_retries - 1) * RETRY_MESSAGE_TOKENS
+    return split_paper(paper_txt, build_messages(citation, paragraph, ""), output_tokens, model)
 
-        if not text_found:
-            reconstructed_text = validate_and_reconstruct(paper_txt, response_text)
-            if reconstructed_text:
-                json_obj['quote'] = reconstructed_text
-                break
 
-        if not text_found:
-            messages.append({"role": "assistant", "content": response_text})
+def confidence_rank(json_obj: dict) -> int:
+    return CONFIDENCE_RANK.get(str(json_obj.get("confidence", "")).upper(), 0)
 
-            if paper_contains_text(paragraph, response_text):
-                error_msg = ("You returned an quote from the paragraph with the claim instead of from the paper. "
-                             "I hope you realize this seriously jeopardizes are scientific project, as semantic similarity will be 100%. "
-                             "Fix it and return the JSON with a quote from the paper instead nothing else.")
-            else:
-                error_msg = ("AUTOMATIC VERIFICATION FAILED: the quote is not found in the paper. "
-                             "Fix your response and return the JSON with an EXACT quote from the PAPER TEXT and nothing else."
-                             "\nMaybe it's an idea to reduce your quote in size so it's more likely the text is found, "
-                             "despite errors. Only semantically meaningful parts are needed.")
-
-            messages.append({"role": "user", "content": error_msg})
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                temperature=0.6
-            )
+
+def quote_rank(json_obj: dict) -> tuple[bool, int]:
+    return bool(json_obj.get("quote")), confidence_rank(json_obj)
+
+
+def is_confident_quote(json_obj: dict) -> bool:
+    return bool(json_obj.get("quote")) and confidence_rank(json_obj) > CONFIDENCE_RANK["LOW"]
+
+
+def request_quote(messages: list[dict], paragraph: str, paper_txt: str, model: str, temperature: float,
+                  stream: bool) -> tuple[str, str | None]:
+    """
+    Returns the answer, and if the answer was streamed and aborted because its quote cannot be verified,
+    the quote received until then.
+    """
+    if not stream:
+        response = chat_completion(model=model, messages=messages, temperature=temperature)
+        return response.choices[0].message.content, None
+    monitor = QuoteMonitor(paragraph, paper_txt)
+    try:
+        response = stream_chat_completion(monitor.should_abort, model=model, messages=messages,
+                                          temperature=temperature)
+        return response.choices[0].message.content, None
+    except StreamAborted as e:
+        return e.content, monitor.quote
+
+
+def ask_for_quote(messages: list[dict], paragraph: str, paper_txt: str, model: str, max_retries: int,
+                  stream: bool = False) -> dict:
+    """
+    Asks for a quote at most max_retries times, telling the model after every rejected answer what was wrong.
+    Returns the answer with the verified quote, or an empty quote if no answer could be verified.
+    """
+    with trace_context(attempt=1):
+        response_text, aborted_quote = request_quote(messages, paragraph, paper_txt, model, 0.0, stream)
+
+    for attempt in range(1, max_retries + 1):
+        if aborted_quote is not None:
+            rejected_text = aborted_quote
         else:
-            print(response_text)
+            try:
+                json_obj = json.loads(extract_json_block(response_text))
+                rejected_text = json_obj['quote']
+            except (ValueError, KeyError):
+                rejected_text = None
+            else:
+                verified_quote = verify_quote(paper_txt, rejected_text)
+                if verified_quote:
+                    json_obj['quote'] = verified_quote
+                    print(verified_quote)
+                    return json_obj
+
+        if attempt == max_retries:
             break
+        if rejected_text is None:
+            reason = "invalid_json"
+            messages.append({"role": "assistant", "content": response_text})
+            messages.append({"role": "user", "content": INVALID_JSON_MESSAGE})
+        else:
+            reason = "quoted_paragraph" if is_paragraph_quote(paragraph, rejected_text) else "quote_not_found"
+            messages.append({"role": "assistant", "content": rejected_text})
+            messages.append({"role": "user", "content": retry_message(paragraph, rejected_text)})
+        with trace_context(attempt=attempt + 1, retry_reason=reason):
+            response_text, aborted_quote = request_quote(messages, paragraph, paper_txt, model, 0.6, stream)
 
-    if i == max_retries:
-        json_obj = {"quote": "", "confidence": "LOW"}
+    return {"quote": "", "confidence": "LOW"}
 
-    return json_obj
 
+def check_claim(citation: str, paragraph: str, paper_txt: str, context_txt: str | None = None,
+                stream: bool = False) -> dict:
+    """
+    Asks for a quote from the paper that substantiates the claim in the paragraph, escalating through the models
+    of the cascade until one gives a verified quote with MEDIUM or HIGH confidence. If context_txt is given,
+    only those passages of the paper are sent, but the quote is still verified against the full paper.
+    With stream, answers are streamed and aborted as soon as their quote can no longer be verified.
+    """
+    return claim_cascade.run(
+        lambda model: check_claim_with_model(citation, paragraph, paper_txt, context_txt, model, stream),
+        accept=is_confident_quote, rank=quote_rank
+    )
 
-def validate_citation_map(citation_map_json, paper_txt: str, references_txt: str) -> list[str]:
-    errors = []
-    ref_lines = []
-    for citation, ref_line in citation_map_json.items():
-        ref_lines.append(ref_line)
-        if citation not in paper_txt:
-            errors.append(f"Citation not found in paper: {citation}")
-        elif ref_line not in references_txt:
-            errors.append(f"References not found in references: {ref_line}")
-    for line in references_txt.splitlines():
-        if line not in ref_lines:
-            errors.append(f"Reference has no citation: {line}")
 
-    return errors
+def check_claim_with_model(citation: str, paragraph: str, paper_txt: str, context_txt: str | None,
+                           model: str, stream: bool = False) -> dict:
+    """
+    A paper that does not fit in the context window is split into windows, which are asked one after the other
+    until one of them gives a quote with HIGH confidence. The quote with the highest confidence is returned.
+    """
+    max_retries = MODEL_RETRIES.get(model, MAX_RETRIES)
+    if context_txt:
+        messages = build_messages(citation, paragraph, context_txt, excerpts=True)
+        return ask_for_quote(messages, paragraph, paper_txt, model, max_retries, stream)
+
+    windows = claim_windows(citation, paragraph, paper_txt, model)
+    if len(windows) == 1:
+        messages = build_messages(citation, paragraph, paper_txt)
+        return ask_for_quote(messages, paragraph, paper_txt, model, max_retries, stream)
+
+    best = {"quote": "", "confidence": "LOW"}
+    for i, window in enumerate(windows, start=1):
+        messages = build_messages(citation, paragraph, window, part=(i, len(windows)))
+        json_obj = ask_for_quote(messages, paragraph, paper_txt, model, max_retries, stream)
+        if json_obj.get("quote") and (not best["quote"] or confidence_rank(json_obj) > confidence_rank(best)):
+            best = json_obj
+        if best["quote"] and confidence_rank(best) == CONFIDENCE_RANK["HIGH"]:
+            break
+    return best
 
 
-def check_claims():
-    with open("doc_to_check/claims.json", "r", encoding="utf-8") as file:
-        claims_map = json.load(file)
-    with open("doc_to_check/file_map.json", "r", encoding="utf-8") as file:
-        file_map = json.load(file)
+def multi_claim_budget(citation: str, paragraphs: list[str]) -> int:
+    """
+    Returns the tokens left for the passages of the paper when all paragraphs are checked in one request.
+    """
+    prompt_messages = build_multi_claim_messages(citation, paragraphs, "", excerpts=True)
+    return context_budget(claim_cascade.models[0], estimate_message_tokens(prompt_messages),
+                          QUOTE_TOKENS * len(paragraphs))
 
-    checked_claims = dict()
 
-    for citation, paragraphs in claims_map.items():
-        claim_substantiations = []
+def check_claims_for_paper(citation: str, paragraphs: list[str], paper_txt: str,
+                           context_txt: str | None = None, stream: bool = False) -> list[dict]:
+    """
+    Asks the first model of the cascade for the quotes of all paragraphs citing the same paper in a single
+    request. Every quote is verified separately; paragraphs whose quote is missing, cannot be verified or has LOW
+    confidence are checked one by one with check_claim, which escalates to the stronger models.
+    """
+    model = claim_cascade.models[0]
+    if context_txt:
+        messages = build_multi_claim_messages(citation, paragraphs, context_txt, excerpts=True)
+    elif len(split_paper(paper_txt, build_multi_claim_messages(citation, paragraphs, ""),
+                         QUOTE_TOKENS * len(paragraphs), model)) == 1:
+        messages = build_multi_claim_messages(citation, paragraphs, paper_txt)
+    else:
+        # Too long to ask for all quotes at once; check_claim splits the paper into windows
+        messages = None
+    quotes = dict()
+    if messages:
         try:
-            paper_file = file_map[citation]
-            with open(f"source_texts_cleaned/{paper_file}", "r", encoding="utf-8") as file:
-                paper_text = file.read()
-            if len(paper_text) > 650000:
-                paper_text = paper_text[:650000]  # cut off to fit context window
-            for paragraph in paragraphs:
-                result = check_claim(citation, paragraph, paper_text)
-                result['paragraph'] = paragraph
-                claim_substantiations.append(result)
+            response = chat_completion(
+                model=model,
+                messages=messages,
+                temperature=0.0
+            )
+            json_obj = json.loads(extract_json_block(response.choices[0].message.content))
+            quotes = {int(item["paragraph"]): item for item in json_obj["quotes"]}
         except Exception as e:
-            print(e)
+            print(f"Failed to check the claims for {citation} in one request: {e}")
+
+    results = []
+    for i, paragraph in enumerate(paragraphs, start=1):
+        item = quotes.get(i)
+        verified_quote = verify_quote(paper_txt, item["quote"]) if item and item.get("quote") else None
+        if verified_quote and (is_confident_quote(item) or len(claim_cascade.models) == 1):
+            results.append({"quote": verified_quote, "confidence": item.get("confidence", "LOW")})
+            continue
+        try:
+            results.append(check_claim(citation, paragraph, paper_txt, stream=stream))
+        except Exception as e:
+            print(f"Failed to check claim for {citation}: {e}")
+            results.append({"quote": "", "confidence": "LOW"})
+    return results
+
+
+def check_paragraphs(citation: str, paragraphs: list[str], paper_txt: str, group_by_paper: bool,
+                     passage_index: PassageIndex | None = None, stream: bool = False) -> list[dict]:
+    with trace_context(citation=citation):
+        if group_by_paper:
+            context_txt = None
+            if passage_index:
+                # The passages of all paragraphs go into one request, so they must fit in its context window
+                context_txt = passage_index.select_context(" ".join(paragraphs), TOP_K * len(paragraphs),
+                                                           max_tokens=multi_claim_budget(citation, paragraphs))
+            return check_claims_for_paper(citation, paragraphs, paper_txt, context_txt, stream)
+        results = []
+        for paragraph in paragraphs:
+            context_txt = passage_index.select_context(paragraph) if passage_index else None
+            results.append(check_claim(citation, paragraph, paper_txt, context_txt, stream))
+        return results
+
+
+def load_paper_text(paper_file: str) -> str:
+    with open(f"source_texts_cleaned/{paper_file}", "r", encoding="utf-8") as file:
+        return file.read()
+
 
-        checked_claims[citation] = claim_substantiations
+JOURNAL_PATH = "doc_to_check/check_citations.jsonl"
+
+
+def journal_line(citation: str, paragraph_idx: int, result: dict) -> str:
+    return json.dumps({"citation": citation, "paragraph_idx": paragraph_idx, **result}, ensure_ascii=False) + "\n"
+
+
+def load_journal(journal_path: str, claims_map: dict) -> dict:
+    """
+    Returns the journaled results by (citation, paragraph index). Results of paragraphs that are no longer in
+    claims.json, or that changed, are skipped, as is a last line cut off by a crash.
+    """
+    journaled = dict()
+    if not os.path.exists(journal_path):
+        return journaled
+    with open(journal_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                citation = result.pop("citation")
+                paragraph_idx = result.pop("paragraph_idx")
+            except (ValueError, KeyError):
+                continue
+            paragraphs = claims_map.get(citation, [])
+            if paragraph_idx < len(paragraphs) and paragraphs[paragraph_idx] == result.get("paragraph"):
+                journaled[(citation, paragraph_idx)] = result
+    return journaled
+
+
+def compile_checked_claims(claims_map: dict, journaled: dict, unavailable: set[str]) -> dict:
+    """
+    Orders the journaled results like claims.json. Paragraphs without a result get an empty quote.
+    """
+    checked_claims = dict()
+    for citation, paragraphs in claims_map.items():
+        if citation in unavailable:
+            checked_claims[citation] = []
+            continue
+        checked_claims[citation] = [journaled.get((citation, i), {"quote": "", "confidence": "LOW",
+                                                                   "paragraph": paragraph})
+                                    for i, paragraph in enumerate(paragraphs)]
+    return checked_claims
+
+
+def check_claims(max_workers: int = 8, group_by_paper: bool = False, use_retrieval: bool = False,
+                 resume: bool = False, stream: bool = False):
+    with open("doc_to_check/claims.json", "r", encoding="utf-8") as file:
+        claims_map = json.load(file)
+    with open("doc_to_check/file_map.json", "r", encoding="utf-8") as file:
+        file_map = json.load(file)
 
+    # Every result is appended to the journal as soon as it is available, so an interrupted run can be resumed.
+    # With resume, the paragraphs already in the journal are skipped; otherwise the journal is started anew.
+    journaled = load_journal(JOURNAL_PATH, claims_map) if resume else dict()
+    journal_lock = threading.Lock()
+    unavailable = set()
+
+    with open(JOURNAL_PATH, "w", encoding="utf-8") as journal:
+        for (citation, paragraph_idx), result in journaled.items():
+            journal.write(journal_line(citation, paragraph_idx, result))
+        journal.flush()
+
+        def journal_results(future, targets: list[list[tuple[str, int]]]):
+            if future.cancelled():
+                return
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f"Failed to check claim for {targets[0][0][0]}: {e}")
+                return
+            with journal_lock:
+                for paragraph_targets, result in zip(targets, results):
+                    for citation, paragraph_idx in paragraph_targets:
+                        entry = dict(result, paragraph=claims_map[citation][paragraph_idx])
+                        journaled[(citation, paragraph_idx)] = entry
+                        journal.write(journal_line(citation, paragraph_idx, entry))
+                journal.flush()
+
+        # The same paragraph is checked only once per paper, even if it is listed more than once or by several
+        # citations of the same paper; its result is journaled for each of them.
+        work = dict()
+        paper_texts = dict()
+        for citation, paragraphs in claims_map.items():
+            pending = [i for i in range(len(paragraphs)) if (citation, i) not in journaled]
+            if not pending:
+                continue
+            try:
+                paper_file = file_map[citation]
+                if paper_file not in paper_texts:
+                    paper_texts[paper_file] = load_paper_text(paper_file)
+            except Exception as e:
+                print(e)
+                unavailable.add(citation)
+                continue
+            for i in pending:
+                work.setdefault(paper_file, dict()).setdefault(paragraphs[i], []).append((citation, i))
+
+        # Paragraphs are checked concurrently. A failing paragraph only loses its own quote.
+        # With group_by_paper, all paragraphs citing a paper are sent in a single request instead.
+        # With use_retrieval, only the passages of the paper relevant to the paragraphs are sent.
+        # With stream, answers whose quote can no longer be verified are aborted while they are generated.
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                futures = []
+                for paper_file, targets in work.items():
+                    paper_text = paper_texts[paper_file]
+                    passage_index = PassageIndex(paper_text) if use_retrieval else None
+                    units = [list(targets)] if group_by_paper else [[paragraph] for paragraph in targets]
+                    for unit in units:
+                        unit_targets = [targets[paragraph] for paragraph in unit]
+                        future = executor.submit(check_paragraphs, unit_targets[0][0][0], unit, paper_text,
+                                                 group_by_paper, passage_index, stream)
+                        future.add_done_callback(
+                            lambda f, unit_targets=unit_targets: journal_results(f, unit_targets))
+                        futures.append(future)
+                wait(futures)
+            except KeyboardInterrupt:
+                # Only the paragraphs that are being checked are finished and journaled
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    checked_claims = compile_checked_claims(claims_map, journaled, unavailable)
     with open("doc_to_check/check_citations.json", "w", encoding="utf-8") as f:
         json.dump(checked_claims, f, ensure_ascii=False, indent=2)
 
 
 if __name__ == "__main__":
-    check_claims()
+    parser = argparse.ArgumentParser(description="Find the quotes in the cited papers that substantiate the claims.")
+    parser.add_argument("--resume", action="store_true",
+                        help=f"skip the paragraphs already checked in {JOURNAL_PATH}")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream the answers and retry as soon as a quote can no longer be verified")
+    args = parser.parse_args()
+    start_trace("claim_checker")
+    check_claims(resume=args.resume, stream=args.stream)
+    claim_cascade.print_stats()
+    print_cache_stats()
 
@@ -0,0 +1,212 @@
+import argparse
+import json
+import os
+
+from claim_checker import (build_messages, claim_windows, confidence_rank, extract_json_block, verify_quote,
+                           retry_message, load_paper_text)
+from llm_client import client
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_MODEL = "gpt-4o"
+MAX_ATTEMPTS = 5
+
+REQUESTS_PATH = "doc_to_check/batch_requests.jsonl"
+RESULTS_PATH = "doc_to_check/batch_results.jsonl"
+RETRY_REQUESTS_PATH = "doc_to_check/batch_retry_requests.jsonl"
+CHECKED_PATH = "doc_to_check/check_citations.json"
+
+
+def make_custom_id(citation_idx: int, paragraph_idx: int, window_idx: int, attempt: int) -> str:
+    """
+    Custom ids refer to the position of the claim in claims.json, so they are stable as long as claims.json is,
+    and to the window of the paper that is sent.
+    """
+    return f"claim-{citation_idx}-{paragraph_idx}-{window_idx}-{attempt}"
+
+
+def parse_custom_id(custom_id: str) -> tuple[int, int, int, int]:
+    _, citation_idx, paragraph_idx, window_idx, attempt = custom_id.split("-")
+    return int(citation_idx), int(paragraph_idx), int(window_idx), int(attempt)
+
+
+def batch_line(custom_id: str, messages: list[dict], temperature: float) -> dict:
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {"model": BATCH_MODEL, "messages": messages, "temperature": temperature}
+    }
+
+
+def read_jsonl(path: str) -> list[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_jsonl(path: str, lines: list[dict]):
+    with open(path, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+
+def build_batch_requests(claims_map: dict, file_map: dict) -> list[dict]:
+    lines = []
+    for citation_idx, (citation, paragraphs) in enumerate(claims_map.items()):
+        try:
+            paper_text = load_paper_text(file_map[citation])
+        except Exception as e:
+            print(e)
+            continue
+        for paragraph_idx, paragraph in enumerate(paragraphs):
+            # Papers that do not fit in the context window get a request per window; collect keeps the best quote
+            windows = claim_windows(citation, paragraph, paper_text, BATCH_MODEL)
+            for window_idx, window in enumerate(windows, start=1):
+                custom_id = make_custom_id(citation_idx, paragraph_idx, window_idx, 1)
+                part = (window_idx, len(windows)) if len(windows) > 1 else None
+                lines.append(batch_line(custom_id, build_messages(citation, paragraph, window, part=part), 0.0))
+    return lines
+
+
+def submit_batch(requests_path: str) -> str:
+    with open(requests_path, "rb") as f:
+        batch_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h"
+    )
+    return batch.id
+
+
+def download_batch_results(batch_id: str, results_path: str) -> bool:
+    batch = client.batches.retrieve(batch_id)
+    if batch.status != "completed":
+        print(f"Batch {batch_id} is {batch.status}")
+        return False
+    content = client.files.content(batch.output_file_id)
+    with open(results_path, "w", encoding="utf-8") as f:
+        f.write(content.text)
+    return True
+
+
+def new_checked_claims(claims_map: dict) -> dict:
+    return {citation: [{"quote": "", "confidence": "LOW", "paragraph": paragraph} for paragraph in paragraphs]
+            for citation, paragraphs in claims_map.items()}
+
+
+def is_retry_round(requests: list[dict]) -> bool:
+    """
+    Only the first round of a batch consists of first attempts; retry rounds are built by collect.
+    """
+    return any(parse_custom_id(line["custom_id"])[3] > 1 for line in requests)
+
+
+def load_checked_claims(checked_path: str, claims_map: dict, retry_round: bool) -> dict:
+    """
+    Loads the results of earlier batch rounds for a retry round, unless they belong to a different claims.json.
+    The first round starts anew, so no quotes of an earlier run are kept for claims missing from its results.
+    """
+    if retry_round and os.path.exists(checked_path):
+        with open(checked_path, "r", encoding="utf-8") as f:
+            checked = json.load(f)
+        if {c: len(p) for c, p in checked.items()} == {c: len(p) for c, p in claims_map.items()}:
+            return checked
+    return new_checked_claims(claims_map)
+
+
+def keep_best_quote(checked: dict, citation: str, paragraph_idx: int, json_obj: dict):
+    """
+    Stores the verified quote, unless a window of the paper already gave one with at least the same confidence.
+    """
+    best = checked[citation][paragraph_idx]
+    if not best["quote"] or confidence_rank(json_obj) > confidence_rank(best):
+        checked[citation][paragraph_idx] = json_obj
+
+
+def collect_batch_results(claims_map: dict, file_map: dict, requests: list[dict], results: list[dict],
+                          checked: dict) -> list[dict]:
+    """
+    Verifies the quotes in the batch results against the papers and stores them in `checked`, keeping the quote
+    with the highest confidence of all windows of a paper. Returns the batch lines to retry for the quotes that could not be verified.
+    """
+    requests_by_id = {line["custom_id"]: line for line in requests}
+    citations = list(claims_map.keys())
+    paper_texts = dict()
+    retry_lines = []
+
+    for result in results:
+        custom_id = result["custom_id"]
+        citation_idx, paragraph_idx, window_idx, attempt = parse_custom_id(custom_id)
+        citation = citations[citation_idx]
+        paragraph = claims_map[citation][paragraph_idx]
+        messages = requests_by_id[custom_id]["body"]["messages"]
+        next_id = make_custom_id(citation_idx, paragraph_idx, window_idx, attempt + 1)
+
+        response = result.get("response")
+        if result.get("error") or not response or response.get("status_code") != 200:
+            print(f"Request {custom_id} failed: {result.get('error')}")
+            if attempt < MAX_ATTEMPTS:
+                retry_lines.append(batch_line(next_id, messages, 0.0))
+            continue
+
+        if citation not in paper_texts:
+            paper_texts[citation] = load_paper_text(file_map[citation])
+        paper_text = paper_texts[citation]
+
+        response_text = response["body"]["choices"][0]["message"]["content"]
+        try:
+            json_obj = json.loads(extract_json_block(response_text))
+            quote = json_obj['quote']
+        except (ValueError, KeyError):
+            if attempt < MAX_ATTEMPTS:
+                retry_lines.append(batch_line(next_id, messages, 0.6))
+            continue
+
+        verified_quote = verify_quote(paper_text, quote)
+        if verified_quote:
+            json_obj['quote'] = verified_quote
+            json_obj['paragraph'] = paragraph
+            keep_best_quote(checked, citation, paragraph_idx, json_obj)
+        elif attempt < MAX_ATTEMPTS:
+            retry_messages = messages + [
+                {"role": "assistant", "content": quote},
+                {"role": "user", "content": retry_message(paragraph, quote)}
+            ]
+            retry_lines.append(batch_line(next_id, retry_messages, 0.6))
+
+    return retry_lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check claims with the OpenAI Batch API.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="write a batch request for every claim in claims.json")
+    submit_parser = subparsers.add_parser("submit", help="upload a batch request file and start the batch")
+    submit_parser.add_argument("requests_path", nargs="?", default=REQUESTS_PATH)
+    download_parser = subparsers.add_parser("download", help="download the results of a completed batch")
+    download_parser.add_argument("batch_id")
+    download_parser.add_argument("results_path", nargs="?", default=RESULTS_PATH)
+    collect_parser = subparsers.add_parser("collect", help="verify batch results and write a retry batch")
+    collect_parser.add_argument("requests_path", nargs="?", default=REQUESTS_PATH)
+    collect_parser.add_argument("results_path", nargs="?", default=RESULTS_PATH)
+    args = parser.parse_args()
+
+    with open("doc_to_check/claims.json", "r", encoding="utf-8") as file:
+        claims_map = json.load(file)
+    with open("doc_to_check/file_map.json", "r", encoding="utf-8") as file:
+        file_map = json.load(file)
+
+    if args.command == "build":
+        write_jsonl(REQUESTS_PATH, build_batch_requests(claims_map, file_map))
+    elif args.command == "submit":
+        print(submit_batch(args.requests_path))
+    elif args.command == "download":
+        download_batch_results(args.batch_id, args.results_path)
+    elif args.command == "collect":
+        requests = read_jsonl(args.requests_path)
+        checked = load_checked_claims(CHECKED_PATH, claims_map, is_retry_round(requests))
+        retry_lines = collect_batch_results(claims_map, file_map, requests, read_jsonl(args.results_path), checked)
+        with open(CHECKED_PATH, "w", encoding="utf-8") as f:
+            json.dump(checked, f, ensure_ascii=False, indent=2)
+        write_jsonl(RETRY_REQUESTS_PATH, retry_lines)
+        print(f"{len(retry_lines)} claims written to {RETRY_REQUESTS_PATH} for a retry batch")
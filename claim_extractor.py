@@ -1,7 +1,9 @@
 import re
 import json
+from bisect import bisect_right
+from collections import deque
 from pathlib import Path
-from typing import List
+from typing import Iterator, List
 
 
 def contains_letters(s: str) -> bool:
@@ -16,17 +18,102 @@ def split_into_paragraphs(text: str) -> List[str]:
     return re.split(r"\n{2,}", text)
 
 
+def split_into_paragraph_spans(text: str) -> List[tuple[int, int]]:
+    """
+    Returns the (start, end) offsets of the stripped paragraphs of split_into_paragraphs.
+    """
+    spans = []
+    pos = 0
+    for separator in re.finditer(r"\n{2,}", text):
+        spans.append((pos, separator.start()))
+        pos = separator.end()
+    spans.append((pos, len(text)))
+
+    stripped = []
+    for start, end in spans:
+        segment = text[start:end]
+        stripped_start = start + len(segment) - len(segment.lstrip())
+        stripped_end = start + len(segment.rstrip())
+        stripped.append((stripped_start, max(stripped_start, stripped_end)))
+    return stripped
+
+
+class CitationMatcher:
+    """
+    Aho-Corasick automaton over the citations, which finds all occurrences of all citations in a single scan.
+    """
+
+    def __init__(self, citations: List[str]):
+        self.citations = [citation for citation in dict.fromkeys(citations) if citation]
+        self.goto = [dict()]
+        self.fail = [0]
+        self.output = [[]]
+
+        for citation in self.citations:
+            state = 0
+            for ch in citation:
+                if ch not in self.goto[state]:
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][ch] = len(self.goto) - 1
+                state = self.goto[state][ch]
+            self.output[state].append(citation)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(ch, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def finditer(self, text: str) -> Iterator[tuple[str, int]]:
+        """
+        Yields every occurrence of every citation as (citation, start offset), ordered by end offset.
+        """
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for citation in output[state]:
+                yield citation, i - len(citation) + 1
+
+
+def find_citation_occurrences(text: str, citations: List[str]) -> dict:
+    """
+    Returns the offsets of all occurrences of every citation in the text.
+    """
+    occurrences = {x: [] for x in citations}
+    for citation, start in CitationMatcher(citations).finditer(text):
+        occurrences[citation].append(start)
+    return occurrences
+
+
 def find_claims(text: str, citations: List[str]) -> dict:
-    paragraphs = split_into_paragraphs(text)
+    spans = split_into_paragraph_spans(text)
+    starts = [start for start, _ in spans]
+
+    # First occurrence of each citation in each paragraph, relative to the start of the paragraph
+    first_occurrences = [dict() for _ in spans]
+    for citation, start in CitationMatcher(citations).finditer(text):
+        idx = bisect_right(starts, start) - 1
+        if idx >= 0 and start + len(citation) <= spans[idx][1]:
+            first_occurrences[idx].setdefault(citation, start - spans[idx][0])
+
     claims = {x: [] for x in citations}
     prev_par = ""
-    for paragraph in paragraphs:
-        paragraph = paragraph.strip()
-        for citation in citations:
-            index = paragraph.find(citation)
-            if index == -1:
-                continue
-            if not contains_letters(paragraph[:index]) and not contains_letters(paragraph[len(citation):]):
+    for (start, end), found in zip(spans, first_occurrences):
+        paragraph = text[start:end]
+        for citation, index in found.items():
+            if not contains_letters(paragraph[:index]) and not contains_letters(paragraph[index + len(citation):]):
                 # accidental break between paragraph and citation
                 claims[citation].append(f"{prev_par} {paragraph}")
             else:
@@ -49,3 +136,11 @@ if __name__ == "__main__":
 
     claims = find_claims(text, citations)
     save_claims(claims, "doc_to_check/claims.json")
+
+    occurrences = find_citation_occurrences(text, citations)
+    Path("doc_to_check/citation_occurrences.json").write_text(
+        json.dumps(occurrences, indent=2, ensure_ascii=False), encoding="utf-8"
+    )
+    for citation, offsets in occurrences.items():
+        if not offsets:
+            print(f"Citation not found: {citation}")
@@ -1,66 +1,184 @@
-import openai
+import argparse
 import json
-from dotenv import load_dotenv
-from sklearn.metrics.pairwise import cosine_similarity
+import os
 
+import numpy as np
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from context_retrieval import split_into_passages
+from instrumentation import start_trace
+from llm_client import create_embeddings, print_cache_stats
+from token_budget import estimate_tokens
 
-load_dotenv(override=True)
 CONFIDENCE_MAP = {"LOW": 0.3, "MEDIUM": 0.6, "HIGH": 0.8}
+EMBEDDING_MODEL = "text-embedding-3-small"
 
+# Limits of a single embeddings request. The token limit is kept below the API's 300,000, because
+# estimate_tokens is only an approximation.
+MAX_BATCH_INPUTS = 2048
+MAX_BATCH_TOKENS = 250000
 
-def get_embedding(text: str) -> list[float]:
-    response = openai.embeddings.create(
-        model="text-embedding-3-small",
-        input=[text]
+# The local backend is fitted on passages of the source texts. Its cosine similarities are lower on average than
+# those of the OpenAI embeddings, so scores of different backends are not comparable.
+LOCAL_CORPUS_DIR = "source_texts_cleaned"
+LOCAL_PASSAGE_WORDS = 100
+LOCAL_DIMENSIONS = 256
+
+
+def embed_batch(texts: list[str]) -> list[list[float]]:
+    response = create_embeddings(
+        model=EMBEDDING_MODEL,
+        input=texts
     )
-    return response.data[0].embedding
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def get_embeddings(texts: list[str]) -> list[list[float]]:
+    """
+    Embeds the texts in as few requests as possible, chunked by the number of inputs and tokens per request.
+    """
+    embeddings = []
+    batch = []
+    batch_tokens = 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= MAX_BATCH_INPUTS or batch_tokens + tokens > MAX_BATCH_TOKENS):
+            embeddings.extend(embed_batch(batch))
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        embeddings.extend(embed_batch(batch))
+    return embeddings
+
+
+def get_embedding(text: str) -> list[float]:
+    return get_embeddings([text])[0]
+
+
+class LocalEmbeddings:
+    """
+    Embeds texts offline as TF-IDF vectors reduced by SVD (latent semantic analysis), fitted on passages of the
+    source texts. The result only depends on the corpus, so it can be reproduced.
+    """
+
+    def __init__(self, corpus_dir: str = LOCAL_CORPUS_DIR, dimensions: int = LOCAL_DIMENSIONS):
+        passages = []
+        for filename in sorted(os.listdir(corpus_dir)):
+            with open(os.path.join(corpus_dir, filename), "r", encoding="utf-8") as f:
+                text = f.read()
+            passages.extend(text[start:end] for start, end in split_into_passages(text, LOCAL_PASSAGE_WORDS, 0))
+        self.vectorizer = TfidfVectorizer(sublinear_tf=True, stop_words="english")
+        tfidf = self.vectorizer.fit_transform(passages)
+        self.svd = TruncatedSVD(n_components=max(1, min(dimensions, min(tfidf.shape) - 1)), random_state=0)
+        self.svd.fit(tfidf)
+        self.name = f"local:tfidf-svd-{self.svd.n_components}"
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        return self.svd.transform(self.vectorizer.transform(texts))
+
 
+def embedding_backend(name: str):
+    """
+    Returns the name to record with the scores and the function that embeds a list of texts.
+    """
+    if name == "openai":
+        return f"openai:{EMBEDDING_MODEL}", get_embeddings
+    if name == "local":
+        local_embeddings = LocalEmbeddings()
+        return local_embeddings.name, local_embeddings
+    raise ValueError(f"Unknown embedding backend: {name}")
 
-def validate_claims(data: dict) -> dict:
-    validated = dict()
 
-    for citation, entries in data.items():
-        validated[citation] = []
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def embed_entries(data: dict, embed=get_embeddings) -> tuple[dict[str, int], np.ndarray]:
+    """
+    Embeds every unique paragraph and quote only once, no matter how many entries share it.
+    Returns the row of each text in a float32 matrix of unit-length embeddings.
+    """
+    texts = dict()
+    for entries in data.values():
         for entry in entries:
-            paragraph = entry["paragraph"]
-            quote = entry["quote"]
-            declared_conf = entry["confidence"]
-
-            emb_par = get_embedding(paragraph)
-            if quote:
-                emb_quote = get_embedding(quote)
-                cos_sim = float(cosine_similarity([emb_par], [emb_quote])[0][0])
-
-                if cos_sim > CONFIDENCE_MAP['HIGH']:
-                    cosine_conf = 'HIGH'
-                elif cos_sim > CONFIDENCE_MAP['MEDIUM']:
-                    cosine_conf = 'MEDIUM'
-                else:
-                    cosine_conf = 'LOW'
-
-                is_consistent = cosine_conf == declared_conf
-
-                score = 0.5 * cos_sim + 0.5 * CONFIDENCE_MAP.get(declared_conf.upper(), 0.3)
-            else:
-                cos_sim = 0.0
-                is_consistent = True
-                score = 0.0
-
-            validated[citation].append({
-                "paragraph": paragraph,
-                "quote": quote,
-                "confidence": declared_conf,
-                "cosine": round(cos_sim, 3),
-                "is_consistent": bool(is_consistent),
-                "score": round(score, 3)
-            })
+            if entry["quote"]:
+                texts[entry["paragraph"]] = None
+                texts[entry["quote"]] = None
+    unique_texts = list(texts)
+    if not unique_texts:
+        return dict(), np.zeros((0, 0), dtype=np.float32)
+    matrix = normalize_rows(np.array(embed(unique_texts), dtype=np.float32))
+    return {text: i for i, text in enumerate(unique_texts)}, matrix
+
+
+def score_claims(paragraph_embeddings: np.ndarray, quote_embeddings: np.ndarray, confidences: list[str],
+                 has_quote: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Scores all entries in one pass. The embeddings must be unit length, so their row-wise dot product is
+    the cosine similarity. Returns the cosine similarities, consistency flags and scores.
+    """
+    cosines = np.einsum("ij,ij->i", paragraph_embeddings, quote_embeddings) if len(has_quote) else np.zeros(0)
+    cosines = np.where(has_quote, cosines, 0.0)
+
+    cosine_confidences = np.select(
+        [cosines > CONFIDENCE_MAP['HIGH'], cosines > CONFIDENCE_MAP['MEDIUM']],
+        ['HIGH', 'MEDIUM'],
+        default='LOW'
+    )
+    declared = np.array(confidences, dtype=object)
+    declared_values = np.array([CONFIDENCE_MAP.get(c.upper(), 0.3) for c in confidences], dtype=np.float32)
+
+    is_consistent = np.where(has_quote, cosine_confidences == declared, True)
+    scores = np.where(has_quote, 0.5 * cosines + 0.5 * declared_values, 0.0)
+    return cosines, is_consistent, scores
+
+
+def validate_claims(data: dict, backend: str = "openai") -> dict:
+    backend_name, embed = embedding_backend(backend)
+    index, matrix = embed_entries(data, embed)
+    entries = [(citation, entry) for citation, citation_entries in data.items() for entry in citation_entries]
+
+    has_quote = np.array([bool(entry["quote"]) for _, entry in entries], dtype=bool)
+    paragraph_rows = [index[entry["paragraph"]] if entry["quote"] else 0 for _, entry in entries]
+    quote_rows = [index[entry["quote"]] if entry["quote"] else 0 for _, entry in entries]
+    if has_quote.any():
+        paragraph_embeddings = matrix[paragraph_rows]
+        quote_embeddings = matrix[quote_rows]
+    else:
+        paragraph_embeddings = quote_embeddings = np.zeros((len(entries), 1), dtype=np.float32)
+
+    cosines, is_consistent, scores = score_claims(paragraph_embeddings, quote_embeddings,
+                                                  [entry["confidence"] for _, entry in entries], has_quote)
+
+    validated = {citation: [] for citation in data}
+    for i, (citation, entry) in enumerate(entries):
+        validated[citation].append({
+            "paragraph": entry["paragraph"],
+            "quote": entry["quote"],
+            "confidence": entry["confidence"],
+            "cosine": round(float(cosines[i]), 3),
+            "is_consistent": bool(is_consistent[i]),
+            "score": round(float(scores[i]), 3),
+            "embedding_backend": backend_name
+        })
 
     return validated
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score the quotes by the similarity of their embeddings.")
+    parser.add_argument("--backend", choices=["openai", "local"], default="openai",
+                        help="OpenAI embeddings, or TF-IDF/SVD embeddings fitted on source_texts_cleaned")
+    args = parser.parse_args()
+    start_trace("claim_validator")
+
     with open("doc_to_check/check_citations.json", "r", encoding="utf-8") as file:
         check_citations_map = json.load(file)
-    result = validate_claims(check_citations_map)
+    result = validate_claims(check_citations_map, args.backend)
     with open("doc_to_check/validated_claims.json", "w", encoding="utf-8") as f:
         json.dump(result, f, ensure_ascii=False, indent=2)
+    print_cache_stats()
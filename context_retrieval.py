@@ -0,0 +1,120 @@
+import math
+import re
+from collections import Counter, defaultdict
+
+from token_budget import estimate_tokens
+
+PASSAGE_WORDS = 250
+PASSAGE_OVERLAP = 50
+TOP_K = 8
+# Fraction of the distinct query terms the best passage must contain to trust the retrieval.
+MIN_TERM_COVERAGE = 0.3
+EXCERPT_SEPARATOR = "\n\n[...]\n\n"
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "in", "is", "it", "its", "of",
+    "on", "or", "that", "the", "their", "this", "to", "was", "were", "which", "with", "et", "al"
+}
+
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in STOPWORDS]
+
+
+def split_into_passages(text: str, passage_words: int = PASSAGE_WORDS,
+                        overlap: int = PASSAGE_OVERLAP) -> list[tuple[int, int]]:
+    """
+    Splits the text into overlapping passages of passage_words words.
+    Returns the (start, end) character offsets, so every passage is a verbatim slice of the text.
+    """
+    words = [match.span() for match in re.finditer(r"\S+", text)]
+    stride = max(1, passage_words - overlap)
+    spans = []
+    for i in range(0, len(words), stride):
+        last = min(i + passage_words, len(words)) - 1
+        spans.append((words[i][0], words[last][1]))
+        if last == len(words) - 1:
+            break
+    return spans
+
+
+class PassageIndex:
+    """
+    BM25 index over the overlapping passages of a paper.
+    """
+
+    def __init__(self, text: str, passage_words: int = PASSAGE_WORDS, overlap: int = PASSAGE_OVERLAP):
+        self.text = text
+        self.spans = split_into_passages(text, passage_words, overlap)
+        self.postings = defaultdict(list)
+        self.lengths = []
+        for i, (start, end) in enumerate(self.spans):
+            term_freqs = Counter(tokenize(text[start:end]))
+            self.lengths.append(sum(term_freqs.values()))
+            for term, freq in term_freqs.items():
+                self.postings[term].append((i, freq))
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+
+    def idf(self, term: str) -> float:
+        doc_freq = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.spans) - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def search(self, query: str, top_k: int = TOP_K) -> list[tuple[int, float]]:
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf(term)
+            for i, freq in self.postings.get(term, ()):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[i] / self.avg_length)
+                scores[i] += idf * freq * (BM25_K1 + 1) / (freq + norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+
+    def term_coverage(self, query: str, passage_idx: int) -> float:
+        query_terms = set(tokenize(query))
+        if not query_terms:
+            return 0.0
+        start, end = self.spans[passage_idx]
+        return len(query_terms & set(tokenize(self.text[start:end]))) / len(query_terms)
+
+    def fit_hits(self, hits: list[tuple[int, float]], max_tokens: int) -> list[tuple[int, float]]:
+        """
+        Returns the best hits whose passages fit in max_tokens together. Overlaps are counted twice.
+        """
+        fitting = []
+        tokens = 0
+        for i, score in hits:
+            start, end = self.spans[i]
+            tokens += estimate_tokens(self.text[start:end]) + estimate_tokens(EXCERPT_SEPARATOR)
+            if tokens > max_tokens:
+                break
+            fitting.append((i, score))
+        return fitting
+
+    def select_context(self, query: str, top_k: int = TOP_K, min_term_coverage: float = MIN_TERM_COVERAGE,
+                       max_tokens: int | None = None) -> str | None:
+        """
+        Returns the top_k passages for the query in document order, with overlapping passages merged.
+        With max_tokens, only the best passages that fit in that many estimated tokens are kept.
+        Returns None when the full text should be used instead: when the paper is not larger than the
+        selected passages would be, when even the best passage matches too few of the query terms, or
+        when not even the best passage fits in max_tokens.
+        """
+        if len(self.spans) <= top_k:
+            return None
+        hits = self.search(query, top_k)
+        if not hits or self.term_coverage(query, hits[0][0]) < min_term_coverage:
+            return None
+        if max_tokens is not None:
+            hits = self.fit_hits(hits, max_tokens)
+            if not hits:
+                return None
+
+        merged = []
+        for start, end in sorted(self.spans[i] for i, _ in hits):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return EXCERPT_SEPARATOR.join(self.text[start:end] for start, end in merged)
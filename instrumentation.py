@@ -0,0 +1,182 @@
+import argparse
+import contextvars
+import cProfile
+import json
+import math
+import os
+import pstats
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+TRACE_PATH = "doc_to_check/llm_trace.jsonl"
+PROFILE_DIR = "doc_to_check/profiles"
+
+# Events of the same process share a run id, so the report can be limited to the last run
+RUN_ID = round(time.time(), 3)
+
+_stage = None
+_trace_file = None
+_lock = threading.Lock()
+# Fields added to every event recorded in the current thread, e.g. the citation being checked
+_context = contextvars.ContextVar("trace_context", default={})
+
+
+def start_trace(stage: str, path: str = TRACE_PATH):
+    """
+    Appends the events recorded from now on to the trace, labelled with the stage. Nothing is recorded before.
+    """
+    global _stage, _trace_file
+    with _lock:
+        _stage = stage
+        if _trace_file is None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            _trace_file = open(path, "a", encoding="utf-8")
+
+
+@contextmanager
+def trace_context(**fields):
+    """
+    Adds the fields to the events recorded in the block. Threads of an executor do not inherit the context,
+    so it must be set in the task itself.
+    """
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def record(event: str, **fields):
+    if _trace_file is None:
+        return
+    entry = {"run": RUN_ID, "time": round(time.time(), 3), "event": event, "stage": _stage, **_context.get(),
+             **fields}
+    with _lock:
+        _trace_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        _trace_file.flush()
+
+
+def record_llm_call(endpoint: str, model: str, started: float, usage=None, cache_hit: bool = False, **fields):
+    """
+    Records a request to the OpenAI API, or its cached response. started is the time.perf_counter() of the start.
+    """
+    record(
+        "llm_call",
+        endpoint=endpoint,
+        model=model,
+        latency_s=round(time.perf_counter() - started, 4),
+        prompt_tokens=getattr(usage, "prompt_tokens", None),
+        completion_tokens=getattr(usage, "completion_tokens", None),
+        cache_hit=cache_hit,
+        **fields
+    )
+
+
+@contextmanager
+def profiled(name: str, enabled: bool = True, profile_dir: str = PROFILE_DIR):
+    """
+    Profiles the block with cProfile, saves the stats to profile_dir/name.prof and prints the slowest functions.
+    Only the calling thread is profiled, not the threads of an executor.
+    """
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f"{name}.prof"))
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+
+
+def read_trace(path: str = TRACE_PATH, last_run: bool = False) -> list[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    if last_run and events:
+        run = max(event["run"] for event in events)
+        events = [event for event in events if event["run"] == run]
+    return events
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Nearest-rank percentile, q between 0 and 100.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def summarize_trace(events: list[dict]) -> dict:
+    """
+    Summarizes the LLM calls per stage and model, the retries per citation, the verification paths, and the transport
+    retries and waits of the rate limiter.
+    Latencies and tokens are of the calls sent to the API; cached responses are only counted.
+    """
+    calls = [event for event in events if event["event"] == "llm_call"]
+    groups = defaultdict(list)
+    for call in calls:
+        groups[(call["stage"], call["model"])].append(call)
+
+    per_stage = dict()
+    for (stage, model), group in sorted(groups.items(), key=lambda item: (str(item[0][0]), str(item[0][1]))):
+        sent = [call for call in group if not call["cache_hit"]]
+        latencies = [call["latency_s"] for call in sent if not call.get("error")]
+        per_stage.setdefault(stage, dict())[model] = {
+            "calls": len(group),
+            "cache_hits": len(group) - len(sent),
+            "errors": sum(1 for call in sent if call.get("error")),
+            "aborted": sum(1 for call in sent if call.get("aborted")),
+            "p50_latency_s": round(percentile(latencies, 50), 3),
+            "p95_latency_s": round(percentile(latencies, 95), 3),
+            "total_latency_s": round(sum(latencies), 1),
+            "prompt_tokens": sum(call["prompt_tokens"] or 0 for call in sent),
+            "completion_tokens": sum(call["completion_tokens"] or 0 for call in sent),
+        }
+
+    retries = Counter(call.get("citation") for call in calls if call.get("attempt", 1) > 1)
+    return {
+        "stages": per_stage,
+        "retry_reasons": dict(Counter(call["retry_reason"] for call in calls if call.get("retry_reason"))),
+        "retries_per_citation": dict(retries.most_common()),
+        "verification": dict(Counter(event["path"] for event in events if event["event"] == "verification")),
+        "transport_retries": dict(Counter(event["error"] for event in events if event["event"] == "transport_retry")),
+        "rate_limit_wait_s": round(sum(event["wait_s"] for event in events if event["event"] == "rate_limit_wait"), 1),
+    }
+
+
+def print_report(summary: dict, top: int = 10):
+    for stage, models in summary["stages"].items():
+        for model, stats in models.items():
+            print(f"{stage} {model}: {stats['calls']} calls, {stats['cache_hits']} cached, {stats['errors']} errors, "
+                  f"{stats['aborted']} aborted, latency p50 {stats['p50_latency_s']}s p95 {stats['p95_latency_s']}s "
+                  f"total {stats['total_latency_s']}s, {stats['prompt_tokens']} prompt + "
+                  f"{stats['completion_tokens']} completion tokens")
+    print(f"Retry reasons: {summary['retry_reasons']}")
+    print(f"Verification: {summary['verification']}")
+    print(f"Transport retries: {summary['transport_retries']}, waited {summary['rate_limit_wait_s']}s for rate limits")
+    print("Citations with the most retries:")
+    for citation, count in list(summary["retries_per_citation"].items())[:top]:
+        print(f"  {count:4d}  {citation}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report on the LLM calls recorded in the trace.")
+    parser.add_argument("trace_path", nargs="?", default=TRACE_PATH)
+    parser.add_argument("--last-run", action="store_true", help="only report on the last run")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args()
+
+    report = summarize_trace(read_trace(args.trace_path, args.last_run))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = ".llm_cache/llm_cache.sqlite3"
+
+
+class LLMCache:
+    """
+    On-disk cache of LLM responses, keyed by a hash of the endpoint and all request parameters.
+    Entries older than max_age_days are ignored and evicted. When the cache exceeds max_entries or
+    max_bytes, the least recently used entries are evicted first.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, max_entries: int | None = None, max_bytes: int | None = None,
+                 max_age_days: float | None = None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(endpoint: str, params: dict) -> str:
+        payload = json.dumps({"endpoint": endpoint, "params": params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _min_created_at(self) -> float:
+        return time.time() - self.max_age_days * 86400 if self.max_age_days is not None else 0.0
+
+    def get(self, key: str, count_miss: bool = True) -> str | None:
+        """
+        Returns the cached value of the key. Without count_miss, a lookup that finds nothing is not counted, e.g.
+        for a second lookup of the same request.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND created_at >= ?",
+                (key, self._min_created_at())
+            ).fetchone()
+            if row is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key: str, endpoint: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, endpoint, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, endpoint, value, len(value.encode("utf-8")), now, now)
+            )
+            self._conn.commit()
+
+    def evict(self) -> int:
+        """
+        Removes expired entries, then the least recently used entries until the size limits are met.
+        Returns the number of removed entries.
+        """
+        with self._lock:
+            removed = self._conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (self._min_created_at(),)
+            ).rowcount
+
+            if self.max_entries is not None or self.max_bytes is not None:
+                count, total_size = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()
+                to_remove = []
+                rows = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at")
+                for key, size in rows:
+                    too_many = self.max_entries is not None and count > self.max_entries
+                    too_large = self.max_bytes is not None and total_size > self.max_bytes
+                    if not too_many and not too_large:
+                        break
+                    to_remove.append((key,))
+                    count -= 1
+                    total_size -= size
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", to_remove)
+                removed += len(to_remove)
+
+            self._conn.commit()
+            return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, total_size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entries": count,
+            "bytes": total_size
+        }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
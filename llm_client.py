@@ -0,0 +1,164 @@
+import json
+import os
+import time
+
+from dotenv import load_dotenv
+from openai import OpenAI
+from openai.types import CreateEmbeddingResponse
+from openai.types.chat import ChatCompletion
+
+from instrumentation import record_llm_call
+from llm_cache import LLMCache
+from rate_limiter import RateLimiter
+from token_budget import estimate_message_tokens, estimate_tokens
+
+load_dotenv(override=True)
+api_key = os.getenv("OPENAI_API_KEY")
+# Transient errors are retried by the rate limiter, which knows the limits of all threads
+client = OpenAI(api_key=api_key, max_retries=0)
+
+# Shared by all pipeline stages, so re-running a stage on an unchanged document makes no network calls.
+cache = LLMCache(max_age_days=30)
+# With refresh_cache, every request is sent even if its response is cached, and the new response replaces the
+# cached one. Set it with LLM_CACHE_REFRESH=1, --refresh-cache or --force of pipeline.py to retry a stage.
+refresh_cache = os.getenv("LLM_CACHE_REFRESH") == "1"
+rate_limiter = RateLimiter()
+
+# Completion tokens counted against the tokens per minute of a request without max_tokens
+EXPECTED_OUTPUT_TOKENS = 500
+
+
+def chat_tokens(kwargs: dict) -> int:
+    return estimate_message_tokens(kwargs["messages"]) + (kwargs.get("max_tokens") or EXPECTED_OUTPUT_TOKENS)
+
+
+def embedding_tokens(kwargs: dict) -> int:
+    texts = kwargs["input"] if isinstance(kwargs["input"], list) else [kwargs["input"]]
+    return sum(estimate_tokens(text) for text in texts)
+
+
+def cached_response(key: str, refresh: bool, count_miss: bool = True) -> str | None:
+    if refresh or refresh_cache:
+        return None
+    return cache.get(key, count_miss)
+
+
+def chat_completion(refresh: bool = False, **kwargs) -> ChatCompletion:
+    """
+    Returns the cached response of the request, unless refresh is set, or sends it and caches the response.
+    """
+    started = time.perf_counter()
+    key = LLMCache.make_key("chat.completions", kwargs)
+    cached = cached_response(key, refresh)
+    if cached is not None:
+        response = ChatCompletion.model_validate_json(cached)
+        record_llm_call("chat.completions", kwargs.get("model"), started, response.usage, cache_hit=True)
+        return response
+    try:
+        response = rate_limiter.call(kwargs["model"], chat_tokens(kwargs),
+                                     lambda: client.chat.completions.with_raw_response.create(**kwargs))
+    except Exception as e:
+        record_llm_call("chat.completions", kwargs.get("model"), started, error=type(e).__name__)
+        raise
+    cache.set(key, "chat.completions", response.model_dump_json())
+    record_llm_call("chat.completions", kwargs.get("model"), started, response.usage)
+    return response
+
+
+class StreamAborted(Exception):
+    """
+    Raised when a streamed completion is aborted, with the content received until then.
+    """
+
+    def __init__(self, content: str):
+        super().__init__("Streamed completion aborted")
+        self.content = content
+
+
+def stream_chat_completion(should_abort, refresh: bool = False, **kwargs) -> ChatCompletion:
+    """
+    Streams a chat completion and calls should_abort(content) with the content received so far after every chunk.
+    If it returns True, the stream is closed and StreamAborted is raised. Completed responses are cached like the
+    ones of chat_completion, under the same key, and refresh bypasses the cache like there. The content of an
+    aborted stream is cached too, under a key of its own, and replayed by raising StreamAborted again. Transient
+    errors are only retried until the stream is opened.
+    """
+    started = time.perf_counter()
+    key = LLMCache.make_key("chat.completions", kwargs)
+    cached = cached_response(key, refresh)
+    if cached is not None:
+        response = ChatCompletion.model_validate_json(cached)
+        record_llm_call("chat.completions", kwargs.get("model"), started, response.usage, cache_hit=True)
+        return response
+    aborted_key = LLMCache.make_key("chat.completions.aborted", kwargs)
+    # The miss was already counted by the lookup of the completed response
+    cached = cached_response(aborted_key, refresh, count_miss=False)
+    if cached is not None:
+        # Replayed through should_abort, so the caller sees the same state as when the stream was aborted
+        content = json.loads(cached)["content"]
+        should_abort(content)
+        record_llm_call("chat.completions", kwargs.get("model"), started, cache_hit=True, streamed=True,
+                        aborted=True)
+        raise StreamAborted(content)
+
+    content = ""
+    completion = {"object": "chat.completion", "choices": []}
+    try:
+        stream = rate_limiter.call(kwargs["model"], chat_tokens(kwargs),
+                                   lambda: client.chat.completions.with_raw_response.create(
+                                       stream=True, stream_options={"include_usage": True}, **kwargs))
+        with stream:
+            for chunk in stream:
+                completion.update(id=chunk.id, created=chunk.created, model=chunk.model)
+                if chunk.usage:
+                    completion["usage"] = chunk.usage.model_dump()
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    content += choice.delta.content
+                    if should_abort(content):
+                        raise StreamAborted(content)
+                if choice.finish_reason:
+                    completion["choices"] = [{"index": 0, "finish_reason": choice.finish_reason,
+                                              "message": {"role": "assistant", "content": content}}]
+        if not completion["choices"]:
+            # A stream cut off before its end must not be cached as a complete answer
+            raise ValueError("Streamed completion ended without a finish reason")
+    except StreamAborted:
+        cache.set(aborted_key, "chat.completions.aborted", json.dumps({"content": content}, ensure_ascii=False))
+        record_llm_call("chat.completions", kwargs.get("model"), started, streamed=True, aborted=True)
+        raise
+    except Exception as e:
+        record_llm_call("chat.completions", kwargs.get("model"), started, streamed=True, error=type(e).__name__)
+        raise
+
+    response = ChatCompletion.model_validate(completion)
+    cache.set(key, "chat.completions", response.model_dump_json())
+    record_llm_call("chat.completions", kwargs.get("model"), started, response.usage, streamed=True)
+    return response
+
+
+def create_embeddings(refresh: bool = False, **kwargs) -> CreateEmbeddingResponse:
+    started = time.perf_counter()
+    key = LLMCache.make_key("embeddings", kwargs)
+    cached = cached_response(key, refresh)
+    if cached is not None:
+        response = CreateEmbeddingResponse.model_validate_json(cached)
+        record_llm_call("embeddings", kwargs.get("model"), started, response.usage, cache_hit=True)
+        return response
+    try:
+        response = rate_limiter.call(kwargs["model"], embedding_tokens(kwargs),
+                                     lambda: client.embeddings.with_raw_response.create(**kwargs))
+    except Exception as e:
+        record_llm_call("embeddings", kwargs.get("model"), started, error=type(e).__name__)
+        raise
+    cache.set(key, "embeddings", response.model_dump_json())
+    record_llm_call("embeddings", kwargs.get("model"), started, response.usage)
+    return response
+
+
+def print_cache_stats():
+    stats = cache.stats()
+    print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses (hit rate {stats['hit_rate']}), "
+          f"{stats['entries']} entries, {stats['bytes']} bytes")
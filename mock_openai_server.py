@@ -0,0 +1,234 @@
+import argparse
+import base64
+import hashlib
+import json
+import re
+import threading
+import time
+from array import array
+from collections import Counter
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMBEDDING_DIMENSIONS = 256
+INVENTED_QUOTE = "The effect was not observed in any of the conditions that were tested in this study."
+
+
+class MockSettings:
+    """
+    Behaviour of the mock server. Latencies are in seconds; every request sleeps a random time between
+    latency and latency + jitter. The rates are probabilities per request.
+    Every random draw is derived from the seed and the request, not from the order in which concurrent requests
+    arrive, so the same seed gives the same answers.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.05, error_rate: float = 0.0,
+                 bad_quote_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.bad_quote_rate = bad_quote_rate
+        self.seed = seed
+        self.received = Counter()
+        self.lock = threading.Lock()
+
+    def request_key(self, body: bytes) -> str:
+        """
+        Returns a hash of the request body and how often the same body was received before, so that the retry of a
+        request that failed gets new draws.
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        with self.lock:
+            count = self.received[digest]
+            self.received[digest] += 1
+        return f"{digest}:{count}"
+
+    def draw(self, key: str, purpose: str) -> float:
+        """
+        Returns a number in [0, 1) determined by the seed, the request key and the purpose of the draw.
+        """
+        digest = hashlib.sha256(f"{self.seed}:{key}:{purpose}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def words(text: str) -> set[str]:
+    return set(re.findall(r"[a-z]{3,}", text.lower()))
+
+
+@lru_cache(maxsize=64)
+def paper_sentences(paper_txt: str) -> list[tuple[str, set[str]]]:
+    sentences = re.split(r"(?<=[.!?])\s+", paper_txt)
+    return [(sentence, words(sentence)) for sentence in sentences if len(sentence.split()) >= 5]
+
+
+def find_quote(paper_txt: str, paragraph: str) -> tuple[str, str]:
+    """
+    Returns the sentence of the paper that shares the most words with the paragraph, and a confidence.
+    """
+    paragraph_words = words(paragraph)
+    best, best_overlap = "", 0.0
+    for sentence, sentence_words in paper_sentences(paper_txt):
+        overlap = len(sentence_words & paragraph_words) / len(sentence_words) if sentence_words else 0.0
+        if overlap > best_overlap:
+            best, best_overlap = sentence, overlap
+    confidence = "HIGH" if best_overlap > 0.6 else "MEDIUM" if best_overlap > 0.3 else "LOW"
+    return best, confidence
+
+
+def between_markers(text: str) -> str:
+    match = re.search(r"%%%\n(.*?)\n%%%", text, re.DOTALL)
+    return match.group(1) if match else ""
+
+
+def chat_answer(messages: list[dict], settings: MockSettings, key: str) -> str:
+    """
+    Answers the prompts of the pipeline: an empty map for the citation mapper, which the synthetic documents do
+    not need, and quotes for the claim checker.
+    """
+    if len(messages) < 3 or "mapping scientific references" in messages[0]["content"]:
+        return "```json\n{}\n```"
+
+    paper_txt = between_markers(messages[1]["content"])
+    prompt = messages[2]["content"]
+
+    def quote_for(paragraph: str) -> dict:
+        draw = settings.draw(key, f"quote:{paragraph}")
+        if draw < settings.bad_quote_rate / 2:
+            return {"quote": paragraph.split(". ")[0], "confidence": "HIGH"}
+        if draw < settings.bad_quote_rate:
+            return {"quote": INVENTED_QUOTE, "confidence": "HIGH"}
+        quote, confidence = find_quote(paper_txt, paragraph)
+        return {"quote": quote, "confidence": confidence}
+
+    if "For EACH paragraph" in prompt:
+        paragraphs = re.findall(r"PARAGRAPH (\d+) \(between %%%\):\n%%%\n(.*?)\n%%%", prompt, re.DOTALL)
+        answer = {"quotes": [{"paragraph": int(i), **quote_for(paragraph)} for i, paragraph in paragraphs]}
+    else:
+        answer = quote_for(between_markers(prompt))
+    return "```json\n" + json.dumps(answer, ensure_ascii=False, indent=4) + "\n```"
+
+
+def embedding(text: str) -> list[float]:
+    """
+    Deterministic bag-of-words embedding: every word adds to a dimension chosen by its hash.
+    """
+    vector = [0.0] * EMBEDDING_DIMENSIONS
+    for word in re.findall(r"[a-z]+", text.lower()):
+        vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % EMBEDDING_DIMENSIONS] += 1.0
+    norm = sum(value * value for value in vector) ** 0.5 or 1.0
+    return [value / norm for value in vector]
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    settings = MockSettings()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body: dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        request = json.loads(body)
+        settings = self.settings
+        key = settings.request_key(body)
+        time.sleep(settings.latency + settings.jitter * settings.draw(key, "latency"))
+        if settings.draw(key, "error") < settings.error_rate:
+            self.send_json(500, {"error": {"message": "Mock server error", "type": "server_error"}})
+            return
+
+        if self.path.endswith("/chat/completions"):
+            self.chat_completions(request, key)
+        elif self.path.endswith("/embeddings"):
+            self.embeddings(request)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def chat_completions(self, request: dict, key: str):
+        # The answer only depends on the request, not on how often it failed before
+        content = chat_answer(request["messages"], self.settings, key.split(":")[0])
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in request["messages"])
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": estimate_tokens(content),
+                 "total_tokens": prompt_tokens + estimate_tokens(content)}
+        completion_id = f"chatcmpl-mock-{key[:24]}"
+        if not request.get("stream"):
+            self.send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()),
+                "model": request["model"], "usage": usage,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}]
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        def send_chunk(choices: list[dict], chunk_usage: dict | None = None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": request["model"], "choices": choices}
+            if chunk_usage:
+                chunk["usage"] = chunk_usage
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            for i in range(0, len(content), 16):
+                send_chunk([{"index": 0, "delta": {"content": content[i:i + 16]}, "finish_reason": None}])
+            send_chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            send_chunk([], usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client aborted the stream
+
+    def embeddings(self, request: dict):
+        texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        data = []
+        for i, text in enumerate(texts):
+            vector = embedding(text)
+            if request.get("encoding_format") == "base64":
+                vector = base64.b64encode(array("f", vector).tobytes()).decode("ascii")
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        prompt_tokens = sum(estimate_tokens(text) for text in texts)
+        self.send_json(200, {"object": "list", "model": request["model"], "data": data,
+                             "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}})
+
+
+def start_server(settings: MockSettings, port: int = 0) -> ThreadingHTTPServer:
+    """
+    Starts the server in a background thread. With port 0, a free port is chosen; see server.server_port.
+    """
+    handler = type("Handler", (MockOpenAIHandler,), {"settings": settings})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI chat completions and embeddings API.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--bad-quote-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mock_server = start_server(MockSettings(args.latency, args.jitter, args.error_rate, args.bad_quote_rate, args.seed),
+                               args.port)
+    print(f"Mock OpenAI API on http://127.0.0.1:{mock_server.server_port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        mock_server.shutdown()
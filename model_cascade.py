@@ -0,0 +1,45 @@
+import threading
+from collections import Counter
+
+
+class ModelCascade:
+    """
+    Tries a task with the models in order, from the cheapest to the strongest, and escalates to the next model
+    only when the result of a model is not accepted. Counts how often each model was tried and accepted.
+    """
+
+    def __init__(self, name: str, models: list[str]):
+        self.name = name
+        self.models = models
+        self.tried = Counter()
+        self.accepted = Counter()
+        self.lock = threading.Lock()
+
+    def run(self, attempt, accept, rank=None):
+        """
+        Calls attempt(model) for each model until accept(result) is true. If no result is accepted, returns the
+        result with the highest rank(result), preferring the stronger model on a tie.
+        """
+        best = None
+        for model in self.models:
+            result = attempt(model)
+            accepted = accept(result)
+            with self.lock:
+                self.tried[model] += 1
+                if accepted:
+                    self.accepted[model] += 1
+            if accepted:
+                return result
+            if best is None or rank is None or rank(result) >= rank(best):
+                best = result
+        return best
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {model: {"tried": self.tried[model], "accepted": self.accepted[model]} for model in self.models}
+
+    def print_stats(self):
+        for model, counts in self.stats().items():
+            if counts["tried"]:
+                rate = counts["accepted"] / counts["tried"]
+                print(f"{self.name} {model}: {counts['accepted']} of {counts['tried']} accepted ({rate:.0%})")
@@ -1,13 +1,18 @@
 import os
 import re
 import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, TextIO
+
+PAGE_MARKER = re.compile(r'-{5,}\s*Page\s+\d+\s*-{5,}')
+STREAM_CHUNK_SIZE = 1 << 16
 
 
 def split_pages(text: str) -> list[str]:
     """
     Splits text into pages using common page marker format.
     """
-    pages = re.split(r'-{5,}\s*Page\s+\d+\s*-{5,}', text)
+    pages = PAGE_MARKER.split(text)
     return [page.strip() for page in pages if page.strip()]
 
 
@@ -51,22 +56,29 @@ def split_columns_from_txt(text: str) -> str:
 
 
 def sanitize_lines(text: str) -> str:
-    lines = [line.strip() for line in text.splitlines() if line.strip()]
-    sanitized = []
-    buffer = ""
+    return "\n".join(iter_sanitized_lines(text.splitlines()))
 
+
+def iter_sanitized_lines(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Merges the lines into paragraphs separated by empty lines. Reads ahead only one line,
+    so the lines can be streamed.
+    """
     # Remove double (or more) spaces inside line
-    lines = [re.sub(r'\s{2,}', ' ', line) for line in lines]
+    prepared = (re.sub(r'\s{2,}', ' ', line.strip()) for line in lines if line.strip())
+    buffer = ""
 
     sentence_end = re.compile(r'[.!?]["\')\]]?$')
 
-    for i, line in enumerate(lines):
+    next_line = next(prepared, None)
+    while next_line is not None:
+        line = next_line
+        next_line = next(prepared, None)
+
         # Skip numeric-only lines (e.g. page numbers)
         if re.fullmatch(r'\d+', line):
             continue
 
-        next_line = lines[i + 1] if i + 1 < len(lines) else ""
-
         if buffer:
             if len(buffer) > 1 and buffer[-1] == '-' and buffer[-2].isalpha():
                 buffer = buffer[0:-1]
@@ -78,37 +90,33 @@ def sanitize_lines(text: str) -> str:
 
         if sentence_end.search(line):
             # Ends in punctuation → end of paragraph
-            sanitized.append(buffer.strip())
-            sanitized.append("")
+            yield buffer.strip()
+            yield ""
             buffer = ""
         elif line.startswith("---"):
             # new page marker probably
-            sanitized.append(buffer.strip())
-            sanitized.append("")
+            yield buffer.strip()
+            yield ""
             buffer = ""
         elif next_line and not sentence_end.search(line):
             if re.match(r'^[A-Z]', next_line):
                 # Next line starts with capital → section break
-                sanitized.append(buffer.strip())
-                sanitized.append("")
+                yield buffer.strip()
+                yield ""
                 buffer = ""
             elif next_line.startswith("---"):
                 # new page marker on next line probably
-                sanitized.append(buffer.strip())
-                sanitized.append("")
+                yield buffer.strip()
+                yield ""
                 buffer = ""
             else:
-                if line.endswith('-'):
-                    pass
                 # Next line starts with lowercase → merge (continue buffering)
                 continue
         else:
             # Last line fallback
-            sanitized.append(buffer.strip())
+            yield buffer.strip()
             buffer = ""
 
-    return "\n".join(sanitized)
-
 
 def remove_malformed_diacritics(text: str) -> str:
     """
@@ -145,35 +153,95 @@ def remove_diacritics(text: str) -> str:
     return unicodedata.normalize("NFC", text)
 
 
-def fix_all_txt_files(input_folder: str, output_folder: str) -> None:
-    os.makedirs(output_folder, exist_ok=True)
+def sanitize_text(raw_text: str) -> str:
+    text_without_nbsp = raw_text.replace('\u00A0', ' ')
+    text_without_diacritics = remove_diacritics(text_without_nbsp)
+    pages = split_pages(text_without_diacritics)
+    cleaned_pages = [split_columns_from_txt(page) for page in pages]
+    single_column_text = "\n\n".join(cleaned_pages)
+    return sanitize_lines(single_column_text)
 
-    for filename in os.listdir(input_folder):
-        if not filename.lower().endswith(".txt"):
-            continue
 
-        input_path = os.path.join(input_folder, filename)
-        output_path = os.path.join(output_folder, filename)
+def iter_pages(file: TextIO, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[str]:
+    """
+    Reads the file chunk by chunk and yields the same pages as split_pages on the whole text, with non-breaking
+    spaces and diacritics already removed. Only the current page is kept in memory.
+    """
+    pending = ""  # text read, but not yet cleaned, because it does not end with a line break yet
+    buffer = ""  # cleaned text that has not been split into pages yet
+    while True:
+        chunk = file.read(chunk_size)
+        if chunk:
+            pending += chunk
+            # Diacritics are removed per line, so a combining character is never separated from its letter
+            cut = pending.rfind("\n") + 1
+            if cut == 0:
+                continue
+            ready, pending = pending[:cut], pending[cut:]
+        else:
+            ready, pending = pending, ""
+        buffer += remove_diacritics(ready.replace('\u00A0', ' '))
+
+        if not chunk:
+            yield from split_pages(buffer)
+            return
+
+        markers = list(PAGE_MARKER.finditer(buffer))
+        if markers:
+            # The last marker might still grow with the next chunk, so its page is kept in the buffer.
+            yield from split_pages(buffer[:markers[-1].start()])
+            buffer = buffer[markers[-1].start():]
 
-        try:
+
+def fix_txt_file(input_path: str, output_path: str, streaming: bool = False) -> str | None:
+    """
+    Sanitizes a single file. Returns the error message if it fails.
+    With streaming, the file is read and written one page at a time, with the same result.
+    """
+    try:
+        if streaming:
+            with open(input_path, encoding="utf-8") as f_in, open(output_path, "w", encoding="utf-8") as f_out:
+                lines = (line for page in iter_pages(f_in) for line in split_columns_from_txt(page).splitlines())
+                for i, line in enumerate(iter_sanitized_lines(lines)):
+                    f_out.write(f"\n{line}" if i else line)
+        else:
             with open(input_path, encoding="utf-8") as f:
                 raw_text = f.read()
 
-            text_without_nbsp = raw_text.replace('\u00A0', ' ')
-            text_without_diacritics = remove_diacritics(text_without_nbsp)
-            pages = split_pages(text_without_diacritics)
-            cleaned_pages = [split_columns_from_txt(page) for page in pages]
-            single_column_text = "\n\n".join(cleaned_pages)
-            sanitized_text = sanitize_lines(single_column_text)
+            sanitized_text = sanitize_text(raw_text)
 
             with open(output_path, "w", encoding="utf-8") as f:
                 f.write(sanitized_text)
+    except Exception as e:
+        return str(e)
+    return None
 
+
+def fix_all_txt_files(input_folder: str, output_folder: str, max_workers: int = 1, streaming: bool = False) -> None:
+    """
+    Sanitizes all text files in the input folder. With max_workers > 1, the files are processed in parallel
+    by a pool of processes.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    filenames = [filename for filename in os.listdir(input_folder) if filename.lower().endswith(".txt")]
+    input_paths = [os.path.join(input_folder, filename) for filename in filenames]
+    output_paths = [os.path.join(output_folder, filename) for filename in filenames]
+    streaming_flags = [streaming] * len(filenames)
+
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            errors = list(executor.map(fix_txt_file, input_paths, output_paths, streaming_flags))
+    else:
+        errors = list(map(fix_txt_file, input_paths, output_paths, streaming_flags))
+
+    for filename, error in zip(filenames, errors):
+        if error is None:
             print(f"✔ Processed {filename}")
-        except Exception as e:
-            print(f"✘ Failed to process {filename}: {e}")
+        else:
+            print(f"✘ Failed to process {filename}: {error}")
 
 
 if __name__ == "__main__":
-    fix_all_txt_files("source_texts", "source_texts_cleaned")
+    fix_all_txt_files("source_texts", "source_texts_cleaned", max_workers=os.cpu_count() or 1)
     fix_all_txt_files("doc_to_check", "doc_to_check_cleaned")
@@ -0,0 +1,230 @@
+import argparse
+import hashlib
+import json
+import os
+
+from instrumentation import profiled, start_trace
+
+STATE_PATH = "doc_to_check/pipeline_state.json"
+
+# Settings that change the results of a stage. Changing them re-runs the stage and,
+# if its outputs change, the stages after it.
+SETTINGS = {
+    "sanitize_sources": {"streaming": False},
+    "check_claims": {"group_by_paper": False, "use_retrieval": False, "stream": False},
+    "validate_claims": {"backend": "openai"},
+}
+
+
+class Stage:
+    """
+    A step of the pipeline that reads its input files and writes its output files.
+    Inputs and outputs may be directories.
+    """
+
+    def __init__(self, name: str, run, inputs: list[str], outputs: list[str]):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def fingerprint(self) -> str:
+        """
+        Hash of the contents of the inputs and of the settings of the stage.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps(SETTINGS.get(self.name, {}), sort_keys=True).encode("utf-8"))
+        for path in self.inputs:
+            digest.update(path.encode("utf-8"))
+            digest.update(hash_path(path).encode("utf-8"))
+        return digest.hexdigest()
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_path(path: str) -> str:
+    if os.path.isfile(path):
+        return hash_file(path)
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                file_path = os.path.join(root, filename)
+                digest.update(os.path.relpath(file_path, path).encode("utf-8"))
+                digest.update(hash_file(file_path).encode("utf-8"))
+        return digest.hexdigest()
+    raise FileNotFoundError(f"Input not found: {path}")
+
+
+def sanitize_sources():
+    from pdf_text_sanitizer import fix_all_txt_files
+    fix_all_txt_files("source_texts", "source_texts_cleaned", max_workers=os.cpu_count() or 1,
+                      **SETTINGS["sanitize_sources"])
+
+
+def sanitize_doc():
+    from pdf_text_sanitizer import fix_all_txt_files
+    fix_all_txt_files("doc_to_check", "doc_to_check_cleaned")
+
+
+def map_citations():
+    from citation_mapper import map_citations_to_references
+    with open("doc_to_check/doc_to_check.txt", "r", encoding="utf-8") as f:
+        paper_txt = f.read()
+    with open("sources/references.txt", "r", encoding="utf-8") as f:
+        references_txt = f.read()
+    citation_map = map_citations_to_references(paper_txt, references_txt)
+    with open("doc_to_check/citation_map.json", "w", encoding="utf-8") as f:
+        json.dump(citation_map, f, ensure_ascii=False, indent=2)
+
+
+def map_files():
+    from citation_mapper import citation_map_to_file_map
+    citation_map_to_file_map(
+        citation_map_path="doc_to_check/citation_map.json",
+        references_path="sources/references.txt",
+        sources_dir="source_texts",
+        output_path="doc_to_check/file_map.json"
+    )
+
+
+def extract_claims():
+    from claim_extractor import load_text, find_claims, save_claims
+    text = load_text("doc_to_check/doc_to_check.txt")
+    with open("doc_to_check/citation_map.json", "r", encoding="utf-8") as f:
+        citation_map = json.load(f)
+    save_claims(find_claims(text, list(citation_map.keys())), "doc_to_check/claims.json")
+
+
+def check_claims():
+    from claim_checker import check_claims as run_check_claims
+    run_check_claims(**SETTINGS["check_claims"])
+
+
+def validate_claims():
+    from claim_validator import validate_claims as run_validate_claims
+    with open("doc_to_check/check_citations.json", "r", encoding="utf-8") as f:
+        check_citations_map = json.load(f)
+    with open("doc_to_check/validated_claims.json", "w", encoding="utf-8") as f:
+        json.dump(run_validate_claims(check_citations_map, **SETTINGS["validate_claims"]), f, ensure_ascii=False,
+                  indent=2)
+
+
+def summarize():
+    from summarize_citations import summarize_citations
+    with open("doc_to_check/validated_claims.json", "r", encoding="utf-8") as f:
+        data = json.load(f)
+    with open("doc_to_check/citation_summary.json", "w", encoding="utf-8") as f:
+        json.dump(summarize_citations(data), f, ensure_ascii=False, indent=2)
+
+
+STAGES = [
+    Stage("sanitize_sources", sanitize_sources, ["source_texts"], ["source_texts_cleaned"]),
+    Stage("sanitize_doc", sanitize_doc, ["doc_to_check/doc_to_check.txt"], ["doc_to_check_cleaned"]),
+    Stage("map_citations", map_citations, ["doc_to_check/doc_to_check.txt", "sources/references.txt"],
+          ["doc_to_check/citation_map.json"]),
+    Stage("map_files", map_files, ["doc_to_check/citation_map.json", "sources/references.txt", "source_texts"],
+          ["doc_to_check/file_map.json"]),
+    Stage("extract_claims", extract_claims, ["doc_to_check/doc_to_check.txt", "doc_to_check/citation_map.json"],
+          ["doc_to_check/claims.json"]),
+    Stage("check_claims", check_claims,
+          ["doc_to_check/claims.json", "doc_to_check/file_map.json", "source_texts_cleaned"],
+          ["doc_to_check/check_citations.json"]),
+    Stage("validate_claims", validate_claims, ["doc_to_check/check_citations.json", "source_texts_cleaned"],
+          ["doc_to_check/validated_claims.json"]),
+    Stage("summarize", summarize, ["doc_to_check/validated_claims.json"], ["doc_to_check/citation_summary.json"]),
+]
+
+
+def order_stages(stages: list[Stage]) -> list[Stage]:
+    """
+    Orders the stages so every stage runs after the stages that write its inputs.
+    """
+    producers = {output: stage for stage in stages for output in stage.outputs}
+    ordered = []
+    visiting = set()
+
+    def visit(stage: Stage):
+        if stage in ordered:
+            return
+        if stage.name in visiting:
+            raise ValueError(f"Cycle in the pipeline at stage {stage.name}")
+        visiting.add(stage.name)
+        for path in stage.inputs:
+            if path in producers:
+                visit(producers[path])
+        visiting.discard(stage.name)
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+def load_state(state_path: str) -> dict:
+    if os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return dict()
+
+
+def save_state(state: dict, state_path: str):
+    with open(state_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+
+
+def run_stage(stage: Stage, refresh_cache: bool):
+    """
+    Runs the stage. With refresh_cache, its LLM requests are sent again instead of being answered from the cache.
+    """
+    if not refresh_cache:
+        stage.run()
+        return
+    import llm_client
+    previous = llm_client.refresh_cache
+    llm_client.refresh_cache = True
+    try:
+        stage.run()
+    finally:
+        llm_client.refresh_cache = previous
+
+
+def run_pipeline(stages: list[Stage] = None, force: list[str] = (), state_path: str = STATE_PATH,
+                 profile: bool = False):
+    """
+    Runs the stages whose inputs or settings changed since their last successful run, or whose outputs are missing.
+    Since inputs are compared by content, a stage that re-runs but writes the same outputs does not trigger the
+    stages after it. A forced stage bypasses the LLM cache, so retrying it gets new answers. The LLM calls of every
+    stage are traced, see instrumentation.py. With profile, every stage
+    that runs is profiled with cProfile.
+    """
+    state = load_state(state_path)
+    for stage in order_stages(stages or STAGES):
+        fingerprint = stage.fingerprint()
+        outputs_exist = all(os.path.exists(path) for path in stage.outputs)
+        if stage.name not in force and outputs_exist and state.get(stage.name) == fingerprint:
+            print(f"- Skipping {stage.name}, inputs unchanged")
+            continue
+        print(f"▶ Running {stage.name}")
+        start_trace(stage.name)
+        with profiled(stage.name, enabled=profile):
+            run_stage(stage, refresh_cache=stage.name in force)
+        state[stage.name] = fingerprint
+        save_state(state, state_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipeline, skipping the stages whose inputs did not change.")
+    parser.add_argument("--force", nargs="*", default=[], choices=[stage.name for stage in STAGES],
+                        help="stages to run even if their inputs did not change, without using the LLM cache")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the stages that run with cProfile, see doc_to_check/profiles")
+    args = parser.parse_args()
+    run_pipeline(force=args.force, profile=args.profile)
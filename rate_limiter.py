@@ -0,0 +1,207 @@
+import random
+import re
+import threading
+import time
+
+import openai
+
+from instrumentation import record
+
+# Requests and tokens per minute until the first response tells the actual limits of the account
+DEFAULT_LIMITS = {
+    "gpt-4o": (500, 30000),
+    "gpt-4o-mini": (500, 200000),
+    "text-embedding-3-small": (3000, 1000000),
+}
+FALLBACK_LIMITS = (500, 30000)
+
+MAX_TRANSPORT_RETRIES = 6
+BACKOFF_BASE_S = 1.0
+BACKOFF_MAX_S = 60.0
+# Longest sleep before a waiting request checks the limits again
+WAIT_STEP_S = 1.0
+# Errors worth retrying: rate limits, timeouts, lost connections and server errors
+TRANSIENT_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str | None) -> float | None:
+    """
+    Parses the durations of the x-ratelimit-reset-* headers, like "20ms", "1s" or "6m0s", in seconds.
+    """
+    if not value:
+        return None
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_SECONDS[unit] for number, unit in parts)
+
+
+def parse_int(value: str | None) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Holds up to capacity units and refills at capacity per minute. Units can be taken in advance, so the
+    bucket can go negative; the caller then waits until the units it took would be refilled.
+    Every take returns a ticket: the total number of units that must have been added to the bucket before the
+    taker may go. Takers are therefore served in order, and a later take does not delay an earlier one.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+        # Units added to the bucket since it was created, by refills and by changes of the limits
+        self.added = 0.0
+
+    def refill(self, now: float):
+        level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.added += level - self.level
+        self.level = level
+        self.updated = now
+
+    def take(self, amount: int, now: float) -> float:
+        """
+        Takes the amount and returns the ticket of the taker.
+        """
+        self.refill(now)
+        self.level -= min(amount, self.capacity)
+        return self.added + max(0.0, -self.level)
+
+    def wait_time(self, ticket: float, now: float) -> float:
+        """
+        Returns the seconds until the units of the ticket would be refilled, at the current capacity.
+        """
+        self.refill(now)
+        return max(0.0, (ticket - self.added) * 60 / self.capacity)
+
+    def adjust(self, limit: int | None, remaining: int | None, now: float):
+        """
+        Adopts the limit and remaining units reported by the API, which also counts other clients of the account.
+        A higher limit brings the tickets of the waiting takers forward, fewer remaining units push them back.
+        """
+        self.refill(now)
+        level = self.level
+        if limit:
+            self.level += limit - self.capacity
+            self.capacity = limit
+        if remaining is not None and remaining < self.level:
+            self.level = remaining
+        self.added += self.level - level
+
+
+class RateLimiter:
+    """
+    Schedules the requests to the OpenAI API of all threads, so they stay within the requests and tokens per
+    minute of each model, and retries requests that failed with a transient error after a jittered exponential
+    backoff. The limits are adapted to the x-ratelimit-* headers of the responses.
+    """
+
+    def __init__(self, limits: dict[str, tuple[int, int]] = None, max_retries: int = MAX_TRANSPORT_RETRIES,
+                 backoff_base: float = BACKOFF_BASE_S, backoff_max: float = BACKOFF_MAX_S):
+        self.limits = DEFAULT_LIMITS if limits is None else limits
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.buckets = dict()
+        self.paused_until = dict()
+        self.lock = threading.Lock()
+
+    def model_buckets(self, model: str) -> tuple[TokenBucket, TokenBucket]:
+        if model not in self.buckets:
+            requests_per_minute, tokens_per_minute = self.limits.get(model, FALLBACK_LIMITS)
+            self.buckets[model] = (TokenBucket(requests_per_minute), TokenBucket(tokens_per_minute))
+        return self.buckets[model]
+
+    def wait_time(self, model: str, tickets: tuple[float, float], now: float) -> float:
+        requests, token_bucket = self.model_buckets(model)
+        return max(requests.wait_time(tickets[0], now), token_bucket.wait_time(tickets[1], now),
+                   self.paused_until.get(model, now) - now)
+
+    def acquire(self, model: str, tokens: int):
+        """
+        Blocks until a request of the estimated number of tokens can be sent to the model. Requests are served in
+        the order they arrive. The wait is re-checked every WAIT_STEP_S seconds, so it ends early when a response
+        of another thread raised the limits.
+        """
+        with self.lock:
+            now = time.monotonic()
+            requests, token_bucket = self.model_buckets(model)
+            tickets = requests.take(1, now), token_bucket.take(tokens, now)
+            wait = self.wait_time(model, tickets, now)
+        if wait <= 0:
+            return
+        started = time.monotonic()
+        while wait > 0:
+            time.sleep(min(wait, WAIT_STEP_S))
+            with self.lock:
+                wait = self.wait_time(model, tickets, time.monotonic())
+        record("rate_limit_wait", model=model, wait_s=round(time.monotonic() - started, 3), tokens=tokens)
+
+    def update(self, model: str, headers):
+        with self.lock:
+            now = time.monotonic()
+            requests, token_bucket = self.model_buckets(model)
+            requests.adjust(parse_int(headers.get("x-ratelimit-limit-requests")),
+                            parse_int(headers.get("x-ratelimit-remaining-requests")), now)
+            token_bucket.adjust(parse_int(headers.get("x-ratelimit-limit-tokens")),
+                                parse_int(headers.get("x-ratelimit-remaining-tokens")), now)
+            # With nothing left, the bucket would refill too early if the limit resets later than it refills
+            for kind in ("requests", "tokens"):
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                if parse_int(headers.get(f"x-ratelimit-remaining-{kind}")) == 0 and reset:
+                    self.paused_until[model] = max(self.paused_until.get(model, now), now + reset)
+
+    def pause(self, model: str, seconds: float):
+        """
+        Holds back all requests to the model, e.g. after a 429, so the other threads do not run into it too.
+        """
+        with self.lock:
+            until = time.monotonic() + seconds
+            self.paused_until[model] = max(self.paused_until.get(model, until), until)
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """
+        Returns the seconds to wait before the attempt: the Retry-After of the error if the API sent one,
+        otherwise a random time up to the exponential backoff.
+        """
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after_ms = parse_int(response.headers.get("retry-after-ms"))
+            if retry_after_ms is not None:
+                return min(retry_after_ms / 1000, self.backoff_max)
+            retry_after = parse_int(response.headers.get("retry-after"))
+            if retry_after is not None:
+                return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def call(self, model: str, tokens: int, request):
+        """
+        Sends request(), a call of a with_raw_response method of the client, once the limits allow it, retrying
+        transient errors. Returns the parsed response.
+        """
+        attempt = 0
+        while True:
+            self.acquire(model, tokens)
+            try:
+                raw_response = request()
+            except TRANSIENT_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt, e)
+                if isinstance(e, openai.RateLimitError):
+                    self.pause(model, delay)
+                record("transport_retry", model=model, attempt=attempt + 1, error=type(e).__name__,
+                       delay_s=round(delay, 3))
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.update(model, raw_response.headers)
+            return raw_response.parse()
@@ -1,54 +1,133 @@
 import re
+from array import array
+from collections import Counter
+from functools import lru_cache
 
 GAP = "[...]"
 
+# Local fuzzy alignment of quotes that differ slightly from the paper, e.g. because of OCR errors.
+FUZZY_MIN_SCORE = 0.85  # 1 - edit distance / normalized quote length
+FUZZY_SEED_SIZE = 8
+FUZZY_MAX_SEED_OCCURRENCES = 64  # seeds occurring more often than this carry no information on the position
+FUZZY_MAX_CANDIDATES = 3
+FUZZY_MAX_BAND = 32  # maximum drift, in characters, between the quote and the paper
+
 
 def normalize_text(txt: str) -> str:
     return re.sub(r'[^a-z]+', '', txt.lower())
 
 
+class NormalizedDocument:
+    """
+    A text normalized with normalize_text, together with the offset in the original text of every
+    normalized character, so matches in the normalized text can be mapped back to the original text.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        lowered = text.lower()
+        # 4 bytes per character; 'L' takes 8 on most 64-bit platforms
+        self.offsets = array('I')
+        if len(lowered) == len(text):
+            chunks = []
+            for match in re.finditer(r'[a-z]+', lowered):
+                chunks.append(match.group())
+                self.offsets.extend(range(match.start(), match.end()))
+            self.normalized = ''.join(chunks)
+        else:
+            # A few characters lowercase to more than one character, so the offsets are mapped char by char.
+            chars = []
+            for i, ch in enumerate(text):
+                for lower_ch in ch.lower():
+                    if 'a' <= lower_ch <= 'z':
+                        chars.append(lower_ch)
+                        self.offsets.append(i)
+            self.normalized = ''.join(chars)
+
+    def __len__(self) -> int:
+        return len(self.normalized)
+
+    def contains(self, text: str) -> bool:
+        return normalize_text(text) in self.normalized
+
+    def original_span(self, norm_start: int, norm_end: int) -> str:
+        """
+        Returns the original text from the first to the last character of the normalized range [norm_start, norm_end).
+        """
+        if norm_end <= norm_start:
+            return ""
+        return self.text[self.offsets[norm_start]:self.offsets[norm_end - 1] + 1]
+
+
+@lru_cache(maxsize=8)
+def get_normalized_document(text: str) -> NormalizedDocument:
+    """
+    Normalizes each paper only once, however many quotes are verified against it. A document takes up to five
+    bytes per character, so only the papers being checked at the same time are kept.
+    """
+    return NormalizedDocument(text)
+
+
 def reconstruct_from_trigrams(paper: str, quote: str) -> list[str]:
-    normalized_paper = normalize_text(paper)
+    parts, _ = match_trigrams(get_normalized_document(paper), quote)
+    return parts
+
+
+def longest_match(normalized_paper: str, norm_words: list[str], i: int, start: int) -> tuple[int, int]:
+    """
+    Finds the longest run of words norm_words[i:j], of at least three words, that occurs in the paper at or after
+    start. A longer run cannot occur before the first occurrence of a shorter one, so each extension resumes the
+    search where the previous one was found, and usually only needs to check the next word in place. The paper is
+    traversed at most once per run, instead of once per extension.
+    Returns j and the first position of the run in the paper, or (-1, -1) if the first three words do not occur.
+    """
+    best_j, best_pos = -1, -1
+    pos = start
+    chunk = ""
+    for j in range(i + 1, len(norm_words) + 1):
+        chunk += norm_words[j - 1]
+        if not normalized_paper.startswith(chunk, pos):
+            pos = normalized_paper.find(chunk, pos)
+            if pos == -1:
+                break
+        if j >= i + 3:
+            best_j, best_pos = j, pos
+    return best_j, best_pos
+
+
+def match_trigrams(doc: NormalizedDocument, quote: str) -> tuple[list[str | int], list[tuple[int, int]]]:
+    """
+    Matches the quote against the document in chunks of at least three words, in order.
+    Returns the matched chunks with the size of the gaps between them, and the normalized span of every chunk.
+    """
+    normalized_paper = doc.normalized
     words = quote.split()
+    norm_words = [normalize_text(word) for word in words]
     n = len(words)
     parts = []
+    spans = []
     i = 0
     last_norm_pos = 0  # where to continue searching from
 
     while i < n - 2:
-        found = False
-        longest_match = None
-        match_pos = -1
-        norm_chunk_size = 0
-        gap_size = 0
-
-        for j in range(i + 3, n + 1):  # try chunks from 3 words up
-            chunk = " ".join(words[i:j])
-            norm_chunk = normalize_text(chunk)
-            idx = normalized_paper.find(norm_chunk, last_norm_pos)
-
-            if idx != -1:
-                found = True
-                longest_match = chunk
-                match_pos = idx
-                gap_size = idx - last_norm_pos
-                norm_chunk_size = len(norm_chunk)
-            else:
-                break  # stop at first failure
-
-        if found:
+        j, match_pos = longest_match(normalized_paper, norm_words, i, last_norm_pos)
+
+        if j != -1:
+            gap_size = match_pos - last_norm_pos
+            norm_chunk_size = sum(len(word) for word in norm_words[i:j])
             if len(parts) and gap_size > 0:
                 parts.append(gap_size)
-            parts.append(longest_match)
+            parts.append(" ".join(words[i:j]))
+            spans.append((match_pos, match_pos + norm_chunk_size))
             last_norm_pos = match_pos + norm_chunk_size
-            i += len(longest_match.split())
+            i = j
         else:
             i += 1
 
     # Final tail
     if i < n:
         tail_chunk = " ".join(words[i:])
-        norm_tail = normalize_text(tail_chunk)
+        norm_tail = "".join(norm_words[i:])
         idx = normalized_paper.find(norm_tail, last_norm_pos)
 
         if idx != -1:
@@ -56,8 +135,118 @@ def reconstruct_from_trigrams(paper: str, quote: str) -> list[str]:
             if len(parts) and gap_size > 0:
                 parts.append(gap_size)
             parts.append(tail_chunk)
+            spans.append((idx, idx + len(norm_tail)))
+
+    return parts, spans
 
-    return parts
+
+def find_alignment_candidates(normalized_paper: str, norm_quote: str, slack: int) -> list[int]:
+    """
+    Finds the most likely start positions of the quote in the paper. Every occurrence of a seed, a
+    non-overlapping piece of FUZZY_SEED_SIZE characters of the quote, votes for the position where the
+    quote would start. Candidates closer than slack to a better one, or with less than half the votes of the
+    best one, are skipped.
+    """
+    votes = Counter()
+    for offset in range(0, len(norm_quote) - FUZZY_SEED_SIZE + 1, FUZZY_SEED_SIZE):
+        seed = norm_quote[offset:offset + FUZZY_SEED_SIZE]
+        positions = []
+        pos = normalized_paper.find(seed)
+        while pos != -1 and len(positions) <= FUZZY_MAX_SEED_OCCURRENCES:
+            positions.append(pos)
+            pos = normalized_paper.find(seed, pos + 1)
+        if len(positions) <= FUZZY_MAX_SEED_OCCURRENCES:
+            votes.update(pos - offset for pos in positions)
+
+    candidates = []
+    ranked = votes.most_common()
+    for diagonal, count in ranked:
+        if 2 * count < ranked[0][1]:
+            break
+        if all(abs(diagonal - candidate) > slack for candidate in candidates):
+            candidates.append(diagonal)
+            if len(candidates) == FUZZY_MAX_CANDIDATES:
+                break
+    return candidates
+
+
+def banded_alignment(norm_quote: str, window: str, diagonal: int, band: int) -> tuple[int, int, int]:
+    """
+    Semi-global edit distance between the quote and any substring of the window, restricted to a band around
+    the diagonal where the quote is expected to start in the window.
+    Returns the edit distance and the start and end of the best matching substring of the window.
+    """
+    m = len(norm_quote)
+    w = len(window)
+    inf = m + w + 1
+    size = 2 * band + 1
+
+    # Row i holds the columns j = diagonal + i - band + k for k in range(size).
+    prev_dist = [inf] * (size + 1)
+    prev_start = [0] * (size + 1)
+    for k in range(size):
+        j = diagonal - band + k
+        if 0 <= j <= w:
+            prev_dist[k] = 0  # the match may start anywhere
+            prev_start[k] = j
+
+    for i in range(1, m + 1):
+        q = norm_quote[i - 1]
+        first = diagonal + i - band
+        dist = [inf] * (size + 1)
+        start = [0] * (size + 1)
+        for k in range(max(0, -first), min(size, w - first + 1)):
+            j = first + k
+            best = prev_dist[k + 1] + 1  # character of the quote missing in the window
+            best_start = prev_start[k + 1]
+            if j > 0:
+                substitution = prev_dist[k] + (q != window[j - 1])
+                if substitution < best:
+                    best, best_start = substitution, prev_start[k]
+                if k > 0 and dist[k - 1] + 1 < best:  # extra character in the window
+                    best, best_start = dist[k - 1] + 1, start[k - 1]
+            dist[k] = best
+            start[k] = best_start
+        prev_dist, prev_start = dist, start
+
+    first = diagonal + m - band
+    end_k = min(range(size), key=lambda k: (prev_dist[k], k))
+    return prev_dist[end_k], prev_start[end_k], first + end_k
+
+
+def align_quote(doc: NormalizedDocument, quote: str,
+                min_score: float = FUZZY_MIN_SCORE) -> tuple[int, int, float] | None:
+    """
+    Finds the span of the paper that best matches the quote, allowing small differences.
+    Returns the normalized start and end of the span and its score, or None if no span scores at least min_score.
+    """
+    norm_quote = normalize_text(quote)
+    m = len(norm_quote)
+    if m < 2 * FUZZY_SEED_SIZE:
+        return None
+
+    band = min(FUZZY_MAX_BAND, max(8, int(m * (1 - min_score)) + 1))
+    best = None
+    for diagonal in find_alignment_candidates(doc.normalized, norm_quote, band):
+        window_start = max(0, diagonal - band)
+        window = doc.normalized[window_start:diagonal + m + band]
+        distance, start, end = banded_alignment(norm_quote, window, diagonal - window_start, band)
+        score = 1 - distance / m
+        if score >= min_score and (best is None or score > best[2]):
+            best = (window_start + start, window_start + end, score)
+    return best
+
+
+def fuzzy_match(paper_text: str, quote: str, min_score: float = FUZZY_MIN_SCORE) -> str | None:
+    """
+    Returns the original text of the paper that best matches the quote, or None if nothing matches well enough.
+    """
+    doc = get_normalized_document(paper_text)
+    alignment = align_quote(doc, quote, min_score)
+    if alignment is None:
+        return None
+    start, end, _ = alignment
+    return doc.original_span(start, end)
 
 
 def validate_gaps(parts: list[str | int], max_norm_gap: int = 75) -> bool:
@@ -75,10 +264,25 @@ def reconstruct_parts(parts: list[str]) -> str:
     return ' '.join(parts)
 
 
+def reconstruct_original(doc: NormalizedDocument, spans: list[tuple[int, int]]) -> str:
+    """
+    Returns the matched spans as they appear in the original text. Adjacent spans are merged,
+    so punctuation and line breaks between them are kept.
+    """
+    merged = []
+    for start, end in spans:
+        if merged and start == merged[-1][1]:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return ' '.join(part for part in (doc.original_span(start, end) for start, end in merged) if part)
+
+
 def validate_and_reconstruct(paper_text, quote):
-    parts = reconstruct_from_trigrams(paper_text, quote)
+    doc = get_normalized_document(paper_text)
+    parts, spans = match_trigrams(doc, quote)
     if validate_gaps(parts):
-        return reconstruct_parts(parts)
+        return reconstruct_original(doc, spans)
     else:
         print(parts)
         return None
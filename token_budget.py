@@ -0,0 +1,84 @@
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+# Context windows in tokens
+CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+}
+# Tokens added by the chat format for every message
+MESSAGE_TOKENS = 4
+# Share of the context window that is used, since the token counts are estimates
+SAFETY_MARGIN = 0.9
+# Tokens the windows of a split text have in common, so that a quote at the border of a window is whole in one of them
+WINDOW_OVERLAP_TOKENS = 500
+
+# Runs of ASCII letters, any other letter, groups of up to three digits, or any other character. Tokenizers never
+# merge text across these boundaries, except for spaces, and rarely split an English word into pieces shorter than
+# four letters. Other letters, e.g. accented, Cyrillic or CJK ones, often take a token each, so they are counted
+# one by one to keep the estimate an upper bound.
+TOKEN_PIECE = re.compile(r"[A-Za-z]+|[^\W\d_]|\d{1,3}|[^\s\w]|_")
+
+
+def piece_tokens(piece: str) -> int:
+    return (len(piece) + 3) // 4 if piece[0].isascii() and piece[0].isalpha() else 1
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens of the text without a tokenizer. It rather overestimates than underestimates.
+    """
+    return sum(piece_tokens(piece) for piece in TOKEN_PIECE.findall(text))
+
+
+def estimate_message_tokens(messages: list[dict]) -> int:
+    return sum(estimate_tokens(message["content"]) + MESSAGE_TOKENS for message in messages)
+
+
+def context_budget(model: str, prompt_tokens: int, output_tokens: int) -> int:
+    """
+    Returns the number of tokens left for the text in a request to the model, given the tokens of the rest of the
+    prompt and the tokens reserved for the output.
+    """
+    return int(CONTEXT_WINDOWS[model] * SAFETY_MARGIN) - prompt_tokens - output_tokens
+
+
+@lru_cache(maxsize=8)
+def word_token_offsets(text: str) -> tuple[array, array, array]:
+    """
+    Returns the start and end offsets of the words of the text and the estimated number of tokens before each word.
+    Cached, because the same paper is split for every claim that cites it. Compact arrays of 4-byte integers keep
+    a cached paper at a few bytes per character.
+    """
+    starts = array('I')
+    ends = array('I')
+    offsets = array('I', [0])
+    total = 0
+    for match in re.finditer(r"\S+", text):
+        starts.append(match.start())
+        ends.append(match.end())
+        total += estimate_tokens(match.group())
+        offsets.append(total)
+    return starts, ends, offsets
+
+
+def split_into_windows(text: str, max_tokens: int, overlap_tokens: int = WINDOW_OVERLAP_TOKENS) -> list[str]:
+    """
+    Splits the text into overlapping windows of at most max_tokens estimated tokens, cut at whitespace.
+    Every window is a verbatim slice of the text. Returns the text itself if it fits in one window.
+    """
+    starts, ends, offsets = word_token_offsets(text)
+    if offsets[-1] <= max_tokens:
+        return [text]
+
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+    windows = []
+    start = 0
+    while True:
+        end = max(bisect_right(offsets, offsets[start] + max_tokens) - 1, start + 1)
+        windows.append(text[starts[start]:ends[end - 1]])
+        if end >= len(starts):
+            return windows
+        start = max(bisect_left(offsets, offsets[end] - overlap_tokens), start + 1)